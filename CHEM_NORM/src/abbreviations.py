@@ -1,103 +1,307 @@
 import codecs
+import functools
 import gzip
+import itertools
 import os
 import re
 import json
+import multiprocessing
+import sqlite3
+import urllib.request
+import xml.etree.ElementTree
+from collections import OrderedDict
 
-from bioc import biocxml
+@functools.lru_cache(maxsize = 100000)
+def get_patterns(short):
+	# Compiled patterns for a short form, shared by every document that defines it
+	# TODO Figure out why Java version used word boundaries
+	word_pattern = re.compile("\\b" + re.escape(short) + "\\b")
+	parenthesized_pattern = re.compile("\\s*\\(\\s*" + re.escape(short) + "\\s*\\)\\s*")
+	return word_pattern, parenthesized_pattern
+
+class AbbreviationMatcher:
+	# Finds which short forms of one document occur in a text with a single scan
+
+	def __init__(self, doc_list):
+		self.doc_list = doc_list
+		short2index = {short: index for index, (short, long) in enumerate(doc_list)}
+		# An empty short form is found in every text
+		self.always = {index for index, (short, long) in enumerate(doc_list) if len(short) == 0}
+		shorts = sorted((short for short in short2index if len(short) > 0), key = len, reverse = True)
+		self.pattern = None
+		if len(shorts) > 0:
+			# The lookahead reports a match at every position, the longest short form first
+			# Checking the first character before trying the alternatives lets the scan skip most positions quickly
+			first = "".join(sorted({re.escape(short[0]) for short in shorts}))
+			self.pattern = re.compile("(?=[" + first + "])(?=(" + "|".join(re.escape(short) for short in shorts) + "))")
+		# Every other short form matching at the same position is a prefix of the longest
+		self.prefixes = dict()
+		for short in shorts:
+			self.prefixes[short] = [short2index[short2] for short2 in shorts if short.startswith(short2)]
+
+	def find(self, text):
+		# Returns the indices in doc_list of the short forms that occur in the text
+		present = set(self.always)
+		if not self.pattern is None:
+			for match in self.pattern.finditer(text):
+				present.update(self.prefixes[match.group(1)])
+		return present
+
+def list_files(path):
+	# Yields the abbreviation files in the path, a single file or the files directly in a directory
+	if os.path.isdir(path):
+		# Load abbreviations from any files found
+		dir = os.listdir(path)
+		for item in dir:
+			if os.path.isfile(path + "/" + item):
+				yield path + "/" + item
+	elif os.path.isfile(path):
+		# load directly
+		yield path
+	else:
+		raise RuntimeError("Path is not a directory or normal file: " + path)
+
+def read_tsv(filename):
+	# Yields (document_ID, short, long) for each abbreviation in the TSV file
+	if filename.endswith(".gz"):
+		file = gzip.open(filename, 'rt', encoding="utf-8") 
+	else:
+		file = codecs.open(filename, 'r', encoding="utf-8") 
+	for line in file:
+		line = line.strip()
+		if len(line) == 0:
+			continue
+		try:
+			fields = line.split("\t")
+			document_ID = fields[0]
+			short = fields[1]
+			long = fields[2]
+		except:
+			print("Abbreviation line malformed: \"{}\"".format(line))
+			continue
+		yield document_ID, short, long
+	file.close()
+
+def read_biocxml(filename):
+	# Yields (document_ID, short, long) for each ABBR relation in the BioC file
+	# The file is parsed incrementally, keeping only the ABBR annotations and relations of the current passage
+	document_ID = None
+	path = list()
+	root = None
+	for event, element in xml.etree.ElementTree.iterparse(filename, events = ("start", "end")):
+		if event == "start":
+			if root is None:
+				root = element
+			path.append(element.tag)
+			continue
+		path.pop()
+		if element.tag == "id" and len(path) > 0 and path[-1] == "document":
+			document_ID = element.text
+		elif element.tag == "passage" and len(path) > 0 and path[-1] == "document":
+			yield from read_passage(document_ID, element)
+			element.clear()
+		elif element.tag == "document":
+			# Discard the document
+			root.clear()
+			document_ID = None
+
+def read_passage(document_ID, passage):
+	annotations = ((annotation.get("id"), get_infons(annotation).get("type"), annotation.findtext("text")) for annotation in passage.iterfind("annotation"))
+	relations = ((relation.get("id", ""), get_infons(relation).get("type"), [(node.get("role"), node.get("refid")) for node in relation.iterfind("node")]) for relation in passage.iterfind("relation"))
+	return read_relations(document_ID, annotations, relations)
+
+def read_relations(document_ID, annotations, relations):
+	# Yields (document_ID, short, long) for each ABBR relation in a passage
+	# The annotations are given as (id, type, text) and the relations as (id, type, [(role, refid)])
+	annotation_id2text = dict()
+	for annotation_id, type, text in annotations:
+		if type != "ABBR":
+			continue
+		annotation_id2text[annotation_id] = text
+	for relation_id, type, nodes in relations:
+		if type != "ABBR":
+			continue
+		long = None
+		short = None
+		for role, refid in nodes:
+			if role=="LongForm":
+				long=annotation_id2text.get(refid)
+			elif role=="ShortForm":
+				short=annotation_id2text.get(refid)
+		if not long is None and not short is None:
+			yield document_ID, short, long
+		else:
+			print("WARN Could not identify long form & short form for document " + document_ID + " relation " + relation_id)
+
+def get_infons(element):
+	infons = dict()
+	for infon in element.iterfind("infon"):
+		infons[infon.get("key")] = infon.text
+	return infons
+
+def read_document(document):
+	# Yields (document_ID, short, long) for each ABBR relation in a BioC document that has already been loaded
+	for passage in document.passages:
+		annotations = ((annotation.id, annotation.infons.get("type"), annotation.text) for annotation in passage.annotations)
+		relations = ((relation.id, relation.infons.get("type"), [(node.role, node.refid) for node in relation.nodes]) for relation in passage.relations)
+		yield from read_relations(document.id, annotations, relations)
+
+def read_file(filename):
+	# Yields the abbreviations in one file, by its extension
+	if filename.endswith(".xml"):
+		print("Loading abbreviations from BioC file " + filename)
+		return read_biocxml(filename)
+	if filename.endswith(".tsv"):
+		print("Loading abbreviations from TSV file " + filename)
+		return read_tsv(filename)
+	print("Abbreviation file does not end in xml or tsv, ignoring: \"{}\"".format(filename))
+	return iter(())
+
+def write_index(path, index_filename):
+	# Writes the abbreviations in the path to an SQLite index, see AbbreviationExpander.open_store()
+	connection = sqlite3.connect(index_filename)
+	connection.execute("CREATE TABLE abbreviations (document_id TEXT NOT NULL, short TEXT NOT NULL, long TEXT NOT NULL)")
+	total = 0
+	for filename in list_files(path):
+		count = 0
+		rows = read_file(filename)
+		while True:
+			batch = list(itertools.islice(rows, 100000))
+			if len(batch) == 0:
+				break
+			connection.executemany("INSERT INTO abbreviations VALUES (?, ?, ?)", batch)
+			count += len(batch)
+		print("Indexed " + str(count) + " abbreviations")
+		total += count
+	print("Creating document index")
+	connection.execute("CREATE INDEX abbreviations_document_id ON abbreviations (document_id)")
+	connection.commit()
+	connection.close()
+	print("Indexed " + str(total) + " abbreviations in total")
+
+def connect_index(index_filename):
+	# Opens an index read-only
+	return sqlite3.connect("file:" + urllib.request.pathname2url(os.path.abspath(index_filename)) + "?mode=ro", uri = True)
+
+# Settings of the expander being loaded, inherited by the shard loading processes
+shard_settings = None
+
+def init_shard_loader(abbr_freq_dict, document_filter):
+	global shard_settings
+	shard_settings = (abbr_freq_dict, document_filter)
+
+def load_shard(filename):
+	# Loads one abbreviation file in a worker process, returning its abbreviations per document
+	abbr_freq_dict, document_filter = shard_settings
+	abbr = AbbreviationExpander(abbr_freq_dict)
+	abbr.document_filter = document_filter
+	abbr.load_file(filename)
+	return abbr.abbr_dict
 
 class AbbreviationExpander:
 
 	def __init__(self, abbr_freq_dict = dict()):
 		self.abbr_freq_dict = abbr_freq_dict
 		self.abbr_dict = dict()
+		# Matchers for the most recently expanded documents
+		self.matchers = OrderedDict()
+		self.matcher_cache_size = 64
+		# Optional index created by index_abbreviations.py, documents are read from it on first use
+		self.store = None
+		self.store_filename = None
+		self.stored_documents = OrderedDict()
+		self.document_cache_size = 1000
+		# If set, only abbreviations for these document IDs are loaded
+		self.document_filter = None
 
-	def load(self, path):
-		if os.path.isdir(path):
-			# Load abbreviations from any files found
-			dir = os.listdir(path)
-			for item in dir:
-				if os.path.isfile(path + "/" + item):
-					self.load_file(path + "/" + item)				
-		elif os.path.isfile(path):  
-			# load directly
-			self.load_file(path)
-		else:  
-			raise RuntimeError("Path is not a directory or normal file: " + path)
+	def load(self, path, workers = 1):
+		filenames = list(list_files(path))
+		shards = [filename for filename in filenames if not filename.endswith(".db")]
+		if workers <= 1 or len(shards) <= 1:
+			for filename in filenames:
+				self.load_file(filename)
+			return
+		for filename in filenames:
+			if filename.endswith(".db"):
+				self.open_store(filename)
+		print("Loading " + str(len(shards)) + " abbreviation files with " + str(workers) + " processes")
+		# Results are merged in file order whatever order the workers finish in
+		# Each shard was resolved with add(), so adding its winners again gives the same result as loading the files in order
+		context = multiprocessing.get_context("fork")
+		with context.Pool(workers, init_shard_loader, (self.abbr_freq_dict, self.document_filter)) as pool:
+			for shard_dict in pool.imap(load_shard, shards):
+				for document_ID, doc_dict in shard_dict.items():
+					if len(doc_dict) == 0 and not document_ID in self.abbr_dict:
+						self.abbr_dict[document_ID] = dict()
+					for short, long in doc_dict.items():
+						self.add(document_ID, short, long)
 
 	def load_file(self, filename):
-		if filename.endswith(".xml"):
-			self.load_biocxml(filename)
-		elif filename.endswith(".tsv"):
-			self.load_tsv(filename)
-		else:
-			print("Abbreviation file does not end in xml or tsv, ignoring: \"{}\"".format(filename))
-
-	def load_tsv(self, filename):
-		print("Loading abbreviations from TSV file " + filename)
+		if filename.endswith(".db"):
+			self.open_store(filename)
+			return
 		count = 0
-		if filename.endswith(".gz"):
-			file = gzip.open(filename, 'rt', encoding="utf-8") 
-		else:
-			file = codecs.open(filename, 'r', encoding="utf-8") 
-		for line in file:
-			line = line.strip()
-			if len(line) == 0:
+		skipped = 0
+		for document_ID, short, long in read_file(filename):
+			if not self.document_filter is None and not document_ID in self.document_filter:
+				skipped += 1
 				continue
-			try:
-				fields = line.split("\t")
-				document_ID = fields[0]
-				short = fields[1]
-				long = fields[2]
-				self.add(document_ID, short, long)
-				# Handle plural abbreviations
-				if short.endswith("s") and long.endswith("s"):
-					self.add(document_ID, short[:-1], long[:-1])
-				count += 1
-			except:
-				print("Abbreviation line malformed: \"{}\"".format(line))
-		file.close()
-		print("Loaded " + str(count) + " abbreviations")
-	
-	def load_biocxml(self, filename):
-		print("Loading abbreviations from BioC file " + filename)
-		count = 0
-		with open(filename, 'r') as input_file:
-			collection = biocxml.load(input_file)
-		for document in collection.documents:
-			for passage in document.passages:
-				annotation_id2text = dict()
-				for annotation in passage.annotations:
-					if not "type" in annotation.infons or annotation.infons["type"] != "ABBR":
-						continue
-					annotation_id2text[annotation.id] = annotation.text
-				for relation in passage.relations:
-					if not "type" in relation.infons or relation.infons["type"] != "ABBR":
-						continue
-					long = None
-					short = None
-					for node in relation.nodes:
-						if node.role=="LongForm":
-							long=annotation_id2text.get(node.refid)
-						elif node.role=="ShortForm":
-							short=annotation_id2text.get(node.refid)
-					if not long is None and not short is None:
-						self.add(document.id, short, long)
-						# Handle plural abbreviations
-						if short.endswith("s") and long.endswith("s"):
-							self.add(document.id, short[:-1], long[:-1])
-						count += 1
-					else:
-						print("WARN Could not identify long form & short form for document " + document.id + " relation " + relation.id)
+			self.add_abbreviation(document_ID, short, long)
+			count += 1
 		print("Loaded " + str(count) + " abbreviations")
-	
+		if skipped > 0:
+			print("Skipped " + str(skipped) + " abbreviations for documents not in the input")
+
+	def open_store(self, filename):
+		if not self.store is None:
+			raise RuntimeError("Only one abbreviation index may be loaded: " + filename)
+		print("Opening abbreviation index " + filename)
+		self.store_filename = filename
+		self.store = connect_index(filename)
+		count = self.store.execute("SELECT COUNT(*) FROM abbreviations").fetchone()[0]
+		print("Index contains " + str(count) + " abbreviations")
+
+	def reopen_store(self):
+		# An SQLite connection may not be used after a fork, so each worker process opens its own
+		if not self.store is None:
+			self.store = connect_index(self.store_filename)
+
+	def get_document(self, document_ID):
+		# Returns the abbreviations for the document, reading them from the index if needed, or None if there are none
+		if document_ID in self.stored_documents:
+			self.stored_documents.move_to_end(document_ID)
+		elif not document_ID in self.abbr_dict and not self.store is None:
+			# Replay the rows in their original order, so the result is the same as loading the files
+			rows = self.store.execute("SELECT short, long FROM abbreviations WHERE document_id = ? ORDER BY rowid", (document_ID,)).fetchall()
+			for short, long in rows:
+				self.add_abbreviation(document_ID, short, long)
+			if not document_ID in self.abbr_dict:
+				self.abbr_dict[document_ID] = dict()
+			self.stored_documents[document_ID] = True
+			if len(self.stored_documents) > self.document_cache_size:
+				evicted, _ = self.stored_documents.popitem(last = False)
+				del self.abbr_dict[evicted]
+				self.matchers.pop(evicted, None)
+		return self.abbr_dict.get(document_ID)
+
+	def remove_document(self, document_ID):
+		self.abbr_dict.pop(document_ID, None)
+		self.stored_documents.pop(document_ID, None)
+		self.matchers.pop(document_ID, None)
+
+	def add_abbreviation(self, document_ID, short, long):
+		self.add(document_ID, short, long)
+		# Handle plural abbreviations
+		if short.endswith("s") and long.endswith("s"):
+			self.add(document_ID, short[:-1], long[:-1])
+
 	def add(self, document_ID, short, long):
+		self.matchers.pop(document_ID, None)
 		if not document_ID in self.abbr_dict:
 			self.abbr_dict[document_ID] = dict()
 		doc_dict = self.abbr_dict[document_ID]
-		# TODO Figure out why Java version used word boundaries
-		regex = re.compile("\\b" + re.escape(short) + "\\b")
-		if regex.search(long):
+		word_pattern, parenthesized_pattern = get_patterns(short)
+		if word_pattern.search(long):
 			print("INFO Ignoring abbreviation \"" + short + "\" -> \"" + long + "\" because long form contains short form")
 		elif short in doc_dict:
 			previous_long = doc_dict[short]
@@ -116,33 +320,57 @@ class AbbreviationExpander:
 		return self.abbr_freq_dict[short].get(long, 0)
 
 	def do_sub(self, short, long, text):
+		word_pattern, parenthesized_pattern = get_patterns(short)
 		if text.find(long) >= 0:
-			return re.sub("\s*\(\s*" + re.escape(short) + "\s*\)\s*", " ", text);
+			return parenthesized_pattern.sub(" ", text)
 		# Change all non-overlapping instances of short to long
-		updated = ""
+		parts = list()
 		index = 0
-		for match in re.finditer("\\b" + re.escape(short) + "\\b", text):
+		for match in word_pattern.finditer(text):
 			start, end = match.span()
-			updated += text[index:start] + long
+			parts.append(text[index:start])
+			parts.append(long)
 			index = end
-		# Add text from last match to end (or whole thing if no matches)
-		updated += text[index:]
-		return updated
+		if len(parts) == 0:
+			return text
+		# Add text from last match to end
+		parts.append(text[index:])
+		return "".join(parts)
+
+	def get_matcher(self, document_ID):
+		if document_ID in self.matchers:
+			self.matchers.move_to_end(document_ID)
+			return self.matchers[document_ID]
+		matcher = AbbreviationMatcher(list(self.get_document(document_ID).items()))
+		self.matchers[document_ID] = matcher
+		if len(self.matchers) > self.matcher_cache_size:
+			self.matchers.popitem(last = False)
+		return matcher
 
 	def expand(self, document_ID, text):
-		if not document_ID in self.abbr_dict:
+		if self.get_document(document_ID) is None:
 			return text
-		doc_list = list(self.abbr_dict[document_ID].items())
+		matcher = self.get_matcher(document_ID)
+		doc_list = matcher.doc_list
 		used = [False] * len(doc_list)
 		history = set()
 		result = text
 		while not result in history:
 			history.add(result)
-			for index, (short, long) in enumerate(doc_list):
-				if not used[index] and result.find(short) >= 0:
-					updated = self.do_sub(short, long, result)
-					if updated != result:
-						result = updated
-						used[index] = True
+			# Abbreviations are tried in order, only those whose short form occurs in the current text
+			candidates = sorted(matcher.find(result))
+			position = 0
+			while position < len(candidates):
+				index = candidates[position]
+				position += 1
+				if used[index]:
+					continue
+				short, long = doc_list[index]
+				updated = self.do_sub(short, long, result)
+				if updated != result:
+					result = updated
+					used[index] = True
+					candidates = [index2 for index2 in sorted(matcher.find(result)) if index2 > index]
+					position = 0
 		return result
 
@@ -4,6 +4,7 @@ import os
 import sys
 
 from dictionary_normalizer2 import DictionaryNormalizer2
+import strings
 
 def target_MESH(resource, accession):
 	return resource == "MESH" and not accession.startswith("Q")
@@ -66,5 +67,6 @@ if __name__ == "__main__":
 				estimated_time = remaining / rate
 				print("completed = {}, rate = {}, remaining = {}, estimated_time = {}".format(completed, rate, remaining, estimated_time))
 	print("Total processing time = " + str(datetime.datetime.now() - start))
+	strings.report_missing_unicode()
 	print("Done.")
 	
@@ -0,0 +1,39 @@
+import datetime
+import json
+import sys
+
+import dictionary_snapshot
+from dictionary_normalizer import DictionaryNormalizer
+from normalize import target2filter
+import strings
+
+# Compiles the dictionary files named in the configuration into a single binary snapshot
+# Once the snapshot exists, DictionaryNormalizer memory-maps it instead of loading the dictionary files
+
+if __name__ == "__main__":
+	start = datetime.datetime.now()
+	if len(sys.argv) != 2:
+		print("Usage: <config>")
+		exit()
+	config_filename = sys.argv[1]
+
+	# Load the configuration
+	print("Loading configuration")
+	with open(config_filename) as config_file:
+		config = json.load(config_file)
+	snapshot_filename = config.pop("snapshot_filename", None)
+	if snapshot_filename is None:
+		raise ValueError("Configuration does not define snapshot_filename: " + config_filename)
+
+	# Load from the dictionary files, ignoring any existing snapshot
+	config["intern_ids"] = False
+	filter = target2filter[config["target_resource"]]
+	normalizer = DictionaryNormalizer(config, filter)
+	if normalizer.flat_names is None:
+		normalizer.flatten()
+
+	print("Writing snapshot " + snapshot_filename)
+	dictionary_snapshot.write(normalizer, snapshot_filename, config["target_resource"])
+	print("Total time = " + str(datetime.datetime.now() - start))
+	strings.report_missing_unicode()
+	print("Done.")
@@ -1,54 +1,82 @@
+import array
 import codecs
 import datetime
 import os
-import re
 import json
 import gzip
+import hashlib
 
+import dictionary_snapshot
 import strings
+from mention_cache import MentionCache
+
+# Version of the flattened lookup table file, changed whenever the tables it holds would be computed differently
+flat_table_version = 2
 
 class DictionaryNormalizer:
 
 	def __init__(self, config, target_filter):
 		self.target_filter = target_filter
 		self.unknown_id = config["unknown_id"]
+		self.unknown_entity = self.unknown_id
+		# Optionally intern the entity IDs as indices into the sorted entity table, only mapped back to strings for output
+		self.intern_ids = config.get("intern_ids", False)
+		self.entity_ids = None
+		# Optionally compute every sieve for every mention and log them, slower but gives the same results
+		self.trace_lookups = config.get("trace_lookups", False)
+		# Results for recently seen mentions, across documents
+		self.mention_cache = MentionCache(config.get("mention_cache_size", 100000))
+		# Final results for every known name and every known pair of templates, see flatten()
+		self.flat_names = None
+		self.flat_templates = None
+
+		# Load everything from the compiled snapshot if there is one
+		if "snapshot_filename" in config:
+			if os.path.exists(config["snapshot_filename"]):
+				self.load_snapshot(config["snapshot_filename"], config.get("target_resource"))
+				return
+			print("Snapshot " + config["snapshot_filename"] + " not found, see compile_snapshot.py")
 		
 		print("Loading allowed ID map")
 		start = datetime.datetime.now()
 		file = codecs.open(config["id2type_filename"], 'r', encoding="utf-8")
-		self.allowed_ids = set()
-		self.allowed_ids.add(self.unknown_id)
+		allowed_ids = set()
+		allowed_ids.add(self.unknown_id)
 		for line in file:
 			line = line.strip()
 			if len(line) > 0:
 				fields = line.split("\t")
 				if fields[1].lower() == "true":
-					self.allowed_ids.add(fields[0])
+					allowed_ids.add(fields[0])
 		file.close()
-		print("Loaded " + str(len(self.allowed_ids)) + " allowed IDs")
+		print("Loaded " + str(len(allowed_ids)) + " allowed IDs")
 		print("Elapsed = " + str(datetime.datetime.now() - start))
 		
 		print("Loading name to entity map")
 		start = datetime.datetime.now()
 		if config["name2ids_filename"].endswith(".gz"):
 			with gzip.open(config["name2ids_filename"], "r") as name2ids_file:
-				self.name2ids = {name: set(ids) for name, ids in json.load(name2ids_file).items()}
+				self.name2ids = json.load(name2ids_file)
 		else:
 			with open(config["name2ids_filename"], "r") as name2ids_file:
-				self.name2ids = {name: set(ids) for name, ids in json.load(name2ids_file).items()}
+				self.name2ids = json.load(name2ids_file)
+		if not self.intern_ids:
+			# Many names map to exactly the same IDs, so identical sets are shared
+			postings = dict()
+			self.name2ids = {name: canonicalize(postings, ids) for name, ids in self.name2ids.items()}
 		print("Loaded " + str(len(self.name2ids)) + " names")
 		print("Elapsed = " + str(datetime.datetime.now() - start))
 		
 		print("Creating entity to best name map")
 		start = datetime.datetime.now()
-		self.id2name = self.make_id2name()
-		print("Created " + str(len(self.id2name)) + " ID to name mappings")
+		id2name = self.make_id2name()
+		print("Created " + str(len(id2name)) + " ID to name mappings")
 		print("Elapsed = " + str(datetime.datetime.now() - start))
 		
 		start = datetime.datetime.now()
 		self.load_templates(config["c_template_cache_filename"], config["p_template_cache_filename"])
-		print("Loaded " + str(len(self.c_template2names)) + " c_templates")
-		print("Loaded " + str(len(self.p_template2names)) + " p_templates")
+		print("Loaded " + str(len(self.c_template2ids)) + " c_templates")
+		print("Loaded " + str(len(self.p_template2ids)) + " p_templates")
 		print("Elapsed = " + str(datetime.datetime.now() - start))
 
 		print("Loading entity to entity map")
@@ -62,8 +90,201 @@ class DictionaryNormalizer:
 		print("Loaded " + str(len(self.id2ids)) + " ID to ID mappings")
 		print("Elapsed = " + str(datetime.datetime.now() - start))
 
-	# TODO PERFORMANCE Create non-logging version with shortcut logic
+		print("Creating entity metadata table")
+		start = datetime.datetime.now()
+		self.make_entity_table(allowed_ids, id2name)
+		print("Created metadata for " + str(len(self.entity_flags)) + " entities")
+		print("Elapsed = " + str(datetime.datetime.now() - start))
+
+		if "flat_table_filename" in config:
+			start = datetime.datetime.now()
+			self.load_flat_tables(config["flat_table_filename"])
+			print("Loaded " + str(len(self.flat_names)) + " flattened names")
+			print("Loaded " + str(len(self.flat_templates)) + " flattened template pairs")
+			print("Elapsed = " + str(datetime.datetime.now() - start))
+
+	def make_entity_table(self, allowed_ids, id2name):
+		# Precomputes whether each entity is a target and whether it is allowed, along with its best name
+		entity_set = set(allowed_ids)
+		for ids in self.name2ids.values():
+			entity_set.update(ids)
+		for id, ids in self.id2ids.items():
+			entity_set.add(id)
+			entity_set.update(ids)
+		if not self.intern_ids:
+			self.entity_flags = {identifier: self.get_flags(identifier, allowed_ids) for identifier in entity_set}
+			self.entity_names = id2name
+			return
+		self.intern_entities(sorted(entity_set))
+		self.entity_flags = bytearray(self.get_flags(identifier, allowed_ids) for identifier in self.entity_ids)
+		self.entity_names = [id2name.get(identifier) for identifier in self.entity_ids]
+
+	def get_flags(self, identifier, allowed_ids):
+		flags = 0
+		fields = identifier.split(":")
+		if len(fields) > 1 and self.target_filter(fields[0], fields[1]):
+			flags |= dictionary_snapshot.TARGET_FLAG
+		if identifier in allowed_ids:
+			flags |= dictionary_snapshot.ALLOWED_FLAG
+		return flags
+
+	def intern_entities(self, identifiers):
+		# The identifiers must be sorted, so that the integer order matches the string order
+		self.entity_ids = EntityTable(identifiers)
+		entity2index = self.entity_ids.identifier2index
+		# Identical postings are shared, keyed by their bytes
+		postings = dict()
+		def intern_all(ids):
+			posting = array.array("I", sorted(entity2index[id] for id in ids))
+			return postings.setdefault(posting.tobytes(), posting)
+		self.unknown_entity = entity2index[self.unknown_id]
+		self.name2ids = {name: intern_all(ids) for name, ids in self.name2ids.items()}
+		self.c_template2ids = {template: intern_all(ids) for template, ids in self.c_template2ids.items()}
+		self.p_template2ids = {template: intern_all(ids) for template, ids in self.p_template2ids.items()}
+		self.id2ids = {entity2index[id]: intern_all(ids) for id, ids in self.id2ids.items()}
+
+	def load_snapshot(self, snapshot_filename, target_resource):
+		print("Loading dictionary snapshot " + snapshot_filename)
+		start = datetime.datetime.now()
+		snapshot = dictionary_snapshot.DictionarySnapshot(snapshot_filename)
+		if snapshot.meta["unknown_id"] != self.unknown_id:
+			raise ValueError("Snapshot " + snapshot_filename + " was compiled with unknown_id \"" + snapshot.meta["unknown_id"] + "\"")
+		# The target flags were computed for the target resource when the snapshot was compiled
+		if snapshot.meta["target_resource"] != target_resource:
+			raise ValueError("Snapshot " + snapshot_filename + " was compiled for target resource \"" + snapshot.meta["target_resource"] + "\"")
+		if self.intern_ids:
+			self.entity_ids = snapshot.entities
+			self.unknown_entity = snapshot.entities.find(self.unknown_id)
+			self.entity_flags = snapshot.interned_entity_flags
+			self.entity_names = snapshot.interned_entity_names
+			self.name2ids = snapshot.interned_name2ids
+			self.c_template2ids = snapshot.interned_c_template2ids
+			self.p_template2ids = snapshot.interned_p_template2ids
+			self.id2ids = snapshot.interned_id2ids
+			self.flat_names = snapshot.interned_flat_names
+			self.flat_templates = snapshot.interned_flat_templates
+		else:
+			self.entity_flags = snapshot.entity_flags
+			self.entity_names = snapshot.entity_names
+			self.name2ids = snapshot.name2ids
+			self.c_template2ids = snapshot.c_template2ids
+			self.p_template2ids = snapshot.p_template2ids
+			self.id2ids = snapshot.id2ids
+			self.flat_names = snapshot.flat_names
+			self.flat_templates = snapshot.flat_templates
+		print("Loaded " + str(len(snapshot.entities)) + " entities")
+		print("Loaded " + str(len(self.name2ids)) + " names")
+		print("Loaded " + str(len(self.c_template2ids)) + " c_templates")
+		print("Loaded " + str(len(self.p_template2ids)) + " p_templates")
+		print("Loaded " + str(len(self.id2ids)) + " ID to ID mappings")
+		print("Loaded " + str(len(self.flat_names)) + " flattened names")
+		print("Loaded " + str(len(self.flat_templates)) + " flattened template pairs")
+		print("Elapsed = " + str(datetime.datetime.now() - start))
+
 	def normalize_mention(self, mention_text):
+		target_entities, sieve = self.lookup_mention(mention_text)
+		return target_entities
+
+	def lookup_mention(self, mention_text):
+		# Returns the target entities and the number of the first sieve that found any
+		if self.trace_lookups:
+			return self.trace_mention(mention_text)
+		result = self.mention_cache.get(mention_text)
+		if result is None:
+			target_entities, sieve = self.sieve_mention(mention_text)
+			# The cached entities are shared, so they must not be modified
+			result = (frozenset(target_entities), sieve)
+			self.mention_cache.put(mention_text, result)
+		return result
+
+	def normalize_mentions(self, mention_texts):
+		# Batch form of normalize_mention, returns the target entities for each mention in the same order
+		return [target_entities for target_entities, sieve in self.lookup_mentions(mention_texts)]
+
+	def lookup_mentions(self, mention_texts):
+		# Batch form of lookup_mention, each distinct mention is only looked up once
+		# Each stage runs over every mention still unresolved, so the later stages only see novel strings
+		text2result = dict.fromkeys(mention_texts)
+		if self.trace_lookups:
+			for mention_text in text2result:
+				text2result[mention_text] = self.trace_mention(mention_text)
+			return [text2result[mention_text] for mention_text in mention_texts]
+		pending = list()
+		for mention_text in text2result:
+			result = self.mention_cache.get(mention_text)
+			if result is None:
+				pending.append(mention_text)
+			else:
+				text2result[mention_text] = result
+		computed = dict()
+		# Names
+		remaining = list()
+		for mention_text in pending:
+			result = self.sieve_name(mention_text)
+			if result is None:
+				remaining.append(mention_text)
+			else:
+				computed[mention_text] = result
+		# Templates, mentions with the same templates share their result
+		templates2texts = dict()
+		for mention_text in remaining:
+			templates = get_templates(mention_text)
+			if not templates in templates2texts:
+				templates2texts[templates] = list()
+			templates2texts[templates].append(mention_text)
+		for (c_template, p_template), texts in templates2texts.items():
+			result = self.lookup_templates(c_template, p_template)
+			for mention_text in texts:
+				computed[mention_text] = result
+		# The cached entities are shared, so they must not be modified
+		for mention_text in pending:
+			target_entities, sieve = computed[mention_text]
+			result = (frozenset(target_entities), sieve)
+			self.mention_cache.put(mention_text, result)
+			text2result[mention_text] = result
+		return [text2result[mention_text] for mention_text in mention_texts]
+
+	def sieve_mention(self, mention_text):
+		result = self.sieve_name(mention_text)
+		if not result is None:
+			return result
+		c_template, p_template = get_templates(mention_text)
+		return self.lookup_templates(c_template, p_template)
+
+	def sieve_name(self, mention_text):
+		# Returns the result of the name sieve, or None if the template sieves must be tried
+		if self.flat_names is None:
+			target_entities = self.filter_nontarget(self.name2ids.get(mention_text, ()))
+			if len(target_entities) > 0:
+				return target_entities, 0
+			return None
+		# Every known name is flattened, so a miss means the name lookup is empty
+		return self.flat_names.get(mention_text)
+
+	def lookup_templates(self, c_template, p_template):
+		# Returns the result of the template sieves, from the flat table if it has the templates
+		if not self.flat_templates is None:
+			result = self.flat_templates.get(c_template + "\t" + p_template)
+			if not result is None:
+				return result
+		return self.sieve_templates(c_template, p_template)
+
+	def sieve_templates(self, c_template, p_template):
+		# Only compute each sieve if all previous sieves were empty
+		ctlookup = self.c_template_lookup(c_template)
+		target_entities = self.filter_nontarget(ctlookup)
+		if len(target_entities) > 0:
+			return target_entities, 1
+		ptlookup = self.p_template_lookup(p_template)
+		target_entities = self.filter_nontarget(ptlookup)
+		if len(target_entities) > 0:
+			return target_entities, 2
+		target_entities = self.filter_nontarget(self.entities_lookup(ctlookup))
+		if len(target_entities) > 0:
+			return target_entities, 3
+		return self.filter_nontarget(self.entities_lookup(ptlookup)), 4
+
+	def trace_mention(self, mention_text):
 		nlookup = self.name_lookup(mention_text)
 		c_template, p_template = get_templates(mention_text)
 		ctlookup = self.c_template_lookup(c_template)
@@ -84,55 +305,129 @@ class DictionaryNormalizer:
 		if len(target_entities) == 0:
 			sieve = 4
 			target_entities = self.filter_nontarget(pctlookup)
-		print("LOOKUP\t" + mention_text + "\t" + c_template + "\t" + p_template + "\t" + str(nlookup) + "\t" + str(ctlookup) + "\t" + str(ptlookup) + "\t" + str(ectlookup) + "\t" + str(pctlookup) + "\t" + str(target_entities) + "\t" + str(sieve))
-		return target_entities
+		print("LOOKUP\t" + mention_text + "\t" + c_template + "\t" + p_template + "\t" + self.format_entities(nlookup) + "\t" + self.format_entities(ctlookup) + "\t" + self.format_entities(ptlookup) + "\t" + self.format_entities(ectlookup) + "\t" + self.format_entities(pctlookup) + "\t" + self.format_entities(target_entities) + "\t" + str(sieve))
+		return target_entities, sieve
 		
+	def flatten(self):
+		# Precomputes the final result for every name and for the templates of every name, so that any mention
+		# whose text or templates are known is answered with a single probe
+		print("Flattening the sieves over all names")
+		start = datetime.datetime.now()
+		results = dict()
+		self.flat_names = dict()
+		self.flat_templates = dict()
+		for name, ids in self.name2ids.items():
+			c_template, p_template = get_templates(name)
+			template_key = c_template + "\t" + p_template
+			result = self.flat_templates.get(template_key)
+			if result is None:
+				target_entities, sieve = self.sieve_templates(c_template, p_template)
+				result = share_result(results, target_entities, sieve)
+				self.flat_templates[template_key] = result
+			target_entities = self.filter_nontarget(ids)
+			if len(target_entities) > 0:
+				result = share_result(results, target_entities, 0)
+			self.flat_names[name] = result
+		print("Flattened " + str(len(self.flat_names)) + " names and " + str(len(self.flat_templates)) + " template pairs into " + str(len(results)) + " distinct results")
+		print("Elapsed = " + str(datetime.datetime.now() - start))
+
+	def load_flat_tables(self, flat_table_filename):
+		# Load from the cache if it exists
+		if os.path.exists(flat_table_filename):
+			print("Loading flattened lookup tables from cache")
+			if flat_table_filename.endswith(".gz"):
+				with gzip.open(flat_table_filename, "r") as flat_table_file:
+					flat_tables = json.load(flat_table_file)
+			else:
+				with open(flat_table_filename, "r") as flat_table_file:
+					flat_tables = json.load(flat_table_file)
+			if flat_tables.get("version") != flat_table_version:
+				raise ValueError("Flattened lookup tables " + flat_table_filename + " have version " + str(flat_tables.get("version")) + ", expected " + str(flat_table_version) + "; delete the file to rebuild it")
+			results = dict()
+			self.flat_names = {name: share_result(results, self.from_identifiers(identifiers), sieve) for name, (identifiers, sieve) in flat_tables["names"].items()}
+			self.flat_templates = {key: share_result(results, self.from_identifiers(identifiers), sieve) for key, (identifiers, sieve) in flat_tables["templates"].items()}
+			return
+
+		self.flatten()
+
+		# Write cache to disk
+		print("Writing flattened lookup tables to cache")
+		flat_tables = dict()
+		flat_tables["version"] = flat_table_version
+		flat_tables["names"] = {name: (self.to_identifiers(entities), sieve) for name, (entities, sieve) in self.flat_names.items()}
+		flat_tables["templates"] = {key: (self.to_identifiers(entities), sieve) for key, (entities, sieve) in self.flat_templates.items()}
+		if flat_table_filename.endswith(".gz"):
+			with gzip.open(flat_table_filename, "wt") as flat_table_file:
+				json.dump(flat_tables, flat_table_file)
+		else:
+			with open(flat_table_filename, "w") as flat_table_file:
+				json.dump(flat_tables, flat_table_file)
+
 	def load_templates(self, c_template_cache_filename, p_template_cache_filename):
+		c_template2names, p_template2names = self.load_template2names(c_template_cache_filename, p_template_cache_filename)
+		# Materialize the entities for each template so that a template lookup is a single probe
+		print("Creating template to entity maps")
+		postings = dict()
+		self.c_template2ids = self.make_template2ids(c_template2names, postings)
+		self.p_template2ids = self.make_template2ids(p_template2names, postings)
+
+	def make_template2ids(self, template2names, postings):
+		template2ids = dict()
+		for template, names in template2names.items():
+			ids = set()
+			for name in names:
+				if name in self.name2ids:
+					ids.update(self.name2ids[name])
+			template2ids[template] = canonicalize(postings, ids)
+		return template2ids
+
+	def load_template2names(self, c_template_cache_filename, p_template_cache_filename):
 		# Load from the cache if it exists
 		if os.path.exists(c_template_cache_filename) and os.path.exists(p_template_cache_filename):
 			print("Loading template to name maps from cache")
 			if c_template_cache_filename.endswith(".gz"):
 				with gzip.open(c_template_cache_filename, "r") as c_template_cache_file:
-					self.c_template2names = {template: set(names) for template, names in json.load(c_template_cache_file).items()}
+					c_template2names = json.load(c_template_cache_file)
 			else:
 				with open(c_template_cache_filename, "r") as c_template_cache_file:
-					self.c_template2names = {template: set(names) for template, names in json.load(c_template_cache_file).items()}
+					c_template2names = json.load(c_template_cache_file)
 			if p_template_cache_filename.endswith(".gz"):
 				with gzip.open(p_template_cache_filename, "r") as p_template_cache_file:
-					self.p_template2names = {template: set(names) for template, names in json.load(p_template_cache_file).items()}
+					p_template2names = json.load(p_template_cache_file)
 			else:
 				with open(p_template_cache_filename, "r") as p_template_cache_file:
-					self.p_template2names = {template: set(names) for template, names in json.load(p_template_cache_file).items()}
-			return
+					p_template2names = json.load(p_template_cache_file)
+			return c_template2names, p_template2names
 
-		self.c_template2names = dict()
-		self.p_template2names = dict()
+		c_template2names = dict()
+		p_template2names = dict()
 
 		# Create templates
 		print("Creating template to name map")
 		for name in self.name2ids:
 			c_template, p_template = get_templates(name)
-			if not c_template in self.c_template2names:
-				self.c_template2names[c_template] = set()
-			self.c_template2names[c_template].add(name)
-			if not p_template in self.p_template2names:
-				self.p_template2names[p_template] = set()
-			self.p_template2names[p_template].add(name)
+			if not c_template in c_template2names:
+				c_template2names[c_template] = set()
+			c_template2names[c_template].add(name)
+			if not p_template in p_template2names:
+				p_template2names[p_template] = set()
+			p_template2names[p_template].add(name)
 
 		# Write cache to disk
 		print("Writing template to name maps to cache")
 		if c_template_cache_filename.endswith(".gz"):
 			with gzip.open(c_template_cache_filename, "wt") as c_template_cache_file:
-				json.dump({template: list(names) for template, names in self.c_template2names.items()}, c_template_cache_file, indent = 3)
+				json.dump({template: list(names) for template, names in c_template2names.items()}, c_template_cache_file, indent = 3)
 		else:
 			with open(c_template_cache_filename, "w") as c_template_cache_file:
-				json.dump({template: list(names) for template, names in self.c_template2names.items()}, c_template_cache_file, indent = 3)
+				json.dump({template: list(names) for template, names in c_template2names.items()}, c_template_cache_file, indent = 3)
 		if p_template_cache_filename.endswith(".gz"):
 			with gzip.open(p_template_cache_filename, "wt") as p_template_cache_file:
-				json.dump({template: list(names) for template, names in self.p_template2names.items()}, p_template_cache_file, indent = 3)
+				json.dump({template: list(names) for template, names in p_template2names.items()}, p_template_cache_file, indent = 3)
 		else:
 			with open(p_template_cache_filename, "w") as p_template_cache_file:
-				json.dump({template: list(names) for template, names in self.p_template2names.items()}, p_template_cache_file, indent = 3)
+				json.dump({template: list(names) for template, names in p_template2names.items()}, p_template_cache_file, indent = 3)
+		return c_template2names, p_template2names
 
 	def make_id2name(self):
 		# First pass
@@ -142,7 +437,7 @@ class DictionaryNormalizer:
 			if name2 in name2ids2:
 				name2ids2[name2].update(id_set)
 			else:
-				name2ids2[name2] = id_set.copy()
+				name2ids2[name2] = set(id_set)
 		# Second pass
 		id2count = dict()
 		id2name = dict()
@@ -159,15 +454,73 @@ class DictionaryNormalizer:
 					id2name[id] = name2
 		return id2name
 
+	def load_mention_cache(self, filename, fingerprint):
+		if not os.path.exists(filename):
+			print("Mention cache " + filename + " not found, starting empty")
+			return
+		print("Loading mention cache " + filename)
+		start = datetime.datetime.now()
+		with gzip.open(filename, "rt", encoding="utf-8") as file:
+			cache = json.load(file)
+		if cache["fingerprint"] != fingerprint:
+			print("Mention cache " + filename + " was made with a different dictionary, ignoring")
+			return
+		# Entries are stored least recently used first
+		mentions = cache["mentions"]
+		if len(mentions) > self.mention_cache.capacity:
+			mentions = mentions[len(mentions) - self.mention_cache.capacity:]
+		for mention_text, identifiers, sieve in mentions:
+			self.mention_cache.put(mention_text, (frozenset(self.from_identifiers(identifiers)), sieve))
+		print("Loaded " + str(len(mentions)) + " cached mentions")
+		print("Elapsed = " + str(datetime.datetime.now() - start))
+
+	def save_mention_cache(self, filename, fingerprint):
+		print("Writing mention cache " + filename)
+		cache = dict()
+		cache["fingerprint"] = fingerprint
+		cache["mentions"] = [(mention_text, self.to_identifiers(entities), sieve) for mention_text, (entities, sieve) in self.mention_cache.entries.items()]
+		# Replace the previous cache only once the new one is complete
+		with gzip.open(filename + ".tmp", "wt", encoding="utf-8") as file:
+			json.dump(cache, file)
+		os.replace(filename + ".tmp", filename)
+		print("Wrote " + str(len(cache["mentions"])) + " cached mentions")
+
+	def to_identifiers(self, entities):
+		# Returns the sorted ID strings of the entities, for output
+		if self.entity_ids is None:
+			return sorted(entities)
+		return [self.entity_ids[entity] for entity in sorted(entities)]
+
+	def format_entities(self, entities):
+		# Returns the entities as a set of ID strings, for logging
+		return str(set(self.to_identifiers(entities)))
+
+	def from_identifiers(self, identifiers):
+		# Inverse of to_identifiers, IDs missing from the entity table are dropped
+		if self.entity_ids is None:
+			return set(identifiers)
+		entities = set()
+		for identifier in identifiers:
+			entity = self.entity_ids.find(identifier)
+			if entity >= 0:
+				entities.add(entity)
+		return entities
+
 	def filter_nontarget(self, entities):
-		entities2 = set()
-		for entity in entities:
-			fields = entity.split(":")
-			resource = fields[0]
-			accession = fields[1]
-			if self.target_filter(resource, accession):
-				entities2.add(entity)
-		return entities2
+		entity_flags = self.entity_flags
+		return {entity for entity in entities if entity_flags[entity] & dictionary_snapshot.TARGET_FLAG}
+
+	def is_allowed(self, entity):
+		return (self.entity_flags[entity] & dictionary_snapshot.ALLOWED_FLAG) != 0
+
+	def entity_name(self, entity):
+		# Returns the best name for the entity, or None if it has no name
+		if self.entity_ids is None:
+			return self.entity_names.get(entity)
+		name = self.entity_names[entity]
+		if not name:
+			return None
+		return name
 
 	def name_lookup(self, name):
 		entities = set()
@@ -177,20 +530,10 @@ class DictionaryNormalizer:
 		return entities
 
 	def c_template_lookup(self, template):
-		entities = set()
-		if template in self.c_template2names:
-			for name in self.c_template2names[template]:
-				if name in self.name2ids:
-					entities.update(self.name2ids[name])
-		return entities
+		return set(self.c_template2ids.get(template, ()))
 
 	def p_template_lookup(self, template):
-		entities = set()
-		if template in self.p_template2names:
-			for name in self.p_template2names[template]:
-				if name in self.name2ids:
-					entities.update(self.name2ids[name])
-		return entities
+		return set(self.p_template2ids.get(template, ()))
 
 	def entities_lookup(self, entities):
 		entities2 = set()
@@ -199,53 +542,119 @@ class DictionaryNormalizer:
 				entities2.update(self.id2ids[entity])
 		return entities2 - entities
 
+class EntityTable(list):
+	# Sorted entity IDs, indexed by their interned integer
+
+	def __init__(self, identifiers):
+		super().__init__(identifiers)
+		self.identifier2index = {identifier: index for index, identifier in enumerate(self)}
+
+	def find(self, identifier):
+		# Returns the integer for the ID, or -1 if not present
+		return self.identifier2index.get(identifier, -1)
+
+def dictionary_fingerprint(config):
+	# Content hash of the configuration and of the dictionary files a DictionaryNormalizer loads with it
+	# Cached results hold ID strings, so they do not depend on intern_ids
+	fingerprint = hashlib.sha256()
+	fingerprint.update(json.dumps({key: value for key, value in config.items() if key != "intern_ids"}, sort_keys = True).encode("utf-8"))
+	if "snapshot_filename" in config and os.path.exists(config["snapshot_filename"]):
+		keys = ["snapshot_filename"]
+	else:
+		keys = ["id2type_filename", "name2ids_filename", "id2ids_filename", "c_template_cache_filename", "p_template_cache_filename"]
+		if "flat_table_filename" in config:
+			keys.append("flat_table_filename")
+	for key in keys:
+		if not os.path.exists(config[key]):
+			raise RuntimeError("Dictionary file not found for " + key + ": " + config[key])
+		fingerprint.update(key.encode("utf-8"))
+		with open(config[key], "rb") as file:
+			for block in iter(lambda: file.read(1 << 20), b""):
+				fingerprint.update(block)
+	return fingerprint.hexdigest()
+
+def canonicalize(postings, values):
+	# Returns the shared frozenset equal to values, so that identical postings are only stored once
+	posting = frozenset(values)
+	return postings.setdefault(posting, posting)
+
+def share_result(results, entities, sieve):
+	# Returns the shared (entities, sieve) tuple equal to the arguments, so that identical results are only stored once
+	result = (frozenset(entities), sieve)
+	return results.setdefault(result, result)
+
+# Translation table for the templates: lower case ASCII letters and digits are kept, upper case letters are
+# lowered and every other character becomes a space
+template_table = {code: " " for code in range(128)}
+for c in "abcdefghijklmnopqrstuvwxyz0123456789":
+	template_table[ord(c)] = c
+for c in "ABCDEFGHIJKLMNOPQRSTUVWXYZ":
+	template_table[ord(c)] = c.lower()
+
+# Plural suffix rules for s_stem: the first rule whose suffix matches without matching one of its exceptions is applied
+stem_rules = [
+	# If word ends in "ies" but not "eies" or "aies" then "ies" --> "y"
+	("ies", ("eies", "aies"), "y"),
+	# If a word ends in "es" but not "aes" "ees" or "oes" --> "es" --> "e"
+	("es", ("aes", "ees", "oes"), "e"),
+	# If a word ends in "s" but not "us" or "ss" then "s" --> null
+	("s", ("us", "ss"), ""),
+]
+
 def get_templates(name):
-	# Map to ASCII, lower case
-	c_template = strings.map_to_ASCII(name).lower()
-	# Change non-alphanumeric characters to spaces
-	c_template = re.sub("[^a-z0-9]", " ", c_template)
-	# Change multiple spaces into a single space
-	c_template = c_template.strip()
-	c_template = re.sub("\\s+", " ", c_template)
+	# Map to ASCII, lower case and change non-alphanumeric characters to spaces, leaving single spaces between the tokens
+	tokens = strings.map_to_ASCII(name).translate(template_table).split()
 	# Remove plurals
-	p_template = stem_all(c_template)
-	# Remove spaces between sequences besides digit digit
-	same = p_template == c_template
-	c_template = re.sub("([a-z]) ([a-z])", "\\1\\2", c_template)
-	c_template = re.sub("([a-z]) ([0-9])", "\\1\\2", c_template)
-	c_template = re.sub("([0-9]) ([a-z])", "\\1\\2", c_template)
-	if same:
-		p_template = c_template
-	else:
-		p_template = re.sub("([a-z]) ([a-z])", "\\1\\2", p_template)
-		p_template = re.sub("([a-z]) ([0-9])", "\\1\\2", p_template)
-		p_template = re.sub("([0-9]) ([a-z])", "\\1\\2", p_template)
-	#print("Name \"" + name + "\" was processed to \"" + template + "\"")
-	return c_template, p_template
-
-def stem_all(name):
-	# TODO Performance: should be faster to stem each, then use " ".join()
-	# Note assumption that whitespace has been normalized
-	fields = name.split(" ")
-	name2 = ""
-	for field in fields:
-		name2 = name2 + " " + s_stem(field)
-	return name2.strip()
+	stems = [s_stem(token) for token in tokens]
+	c_template = join_template(tokens)
+	if stems == tokens:
+		return c_template, c_template
+	return c_template, join_template(stems)
+
+def join_template(tokens):
+	# Joins the tokens with single spaces, then removes the spaces between sequences besides digit digit
+	# Gives the same result as applying re.sub("([a-z]) ([a-z])", "\\1\\2", ...), then the same for letter digit and
+	# digit letter. The letter letter substitution does not overlap its matches, so in "a b c" only the first space
+	# is removed. Empty tokens widen the space between their neighbours, which is then never removed
+	parts = list()
+	previous = None
+	width = 0
+	joined = False
+	for token in tokens:
+		if previous is None:
+			if len(token) > 0:
+				parts.append(token)
+				previous = token
+			continue
+		width += 1
+		if len(token) == 0:
+			continue
+		remove = False
+		if width == 1:
+			left_digit = previous[-1] <= "9"
+			right_digit = token[0] <= "9"
+			if not left_digit and not right_digit:
+				# The left letter was already consumed by the previous match
+				remove = not (joined and len(previous) == 1)
+				joined = remove
+			else:
+				remove = not (left_digit and right_digit)
+				joined = False
+		else:
+			joined = False
+		if not remove:
+			parts.append(" " * width)
+		parts.append(token)
+		previous = token
+		width = 0
+	return "".join(parts)
 
 def s_stem(str):
-	# TODO compile these so it's faster
 	# Note assumption str is already lowercase
 	if not str.endswith("s"):
 		return str
-	# If word ends in "ies" but not "eies" or "aies" then "ies" --> "y"
-	if (str.endswith("ies") and not str.endswith("eies") and not str.endswith("aies")):
-		return re.sub("ies$", "y", str)
-	# If a word ends in "es" but not "aes" "ees" or "oes" --> "es" --> "e"
-	if (str.endswith("es") and not str.endswith("aes") and not str.endswith("ees") and not str.endswith("oes")):
-		return re.sub("es$", "e", str)
-	# If a word ends in "s" but not "us" or "ss" then "s" --> null
-	if (not str.endswith("us") and not str.endswith("ss")):
-		return re.sub("s$", "", str)
+	for suffix, exceptions, replacement in stem_rules:
+		if str.endswith(suffix) and not str.endswith(exceptions):
+			return str[:len(str) - len(suffix)] + replacement
 	# Return as-is
 	return str
-
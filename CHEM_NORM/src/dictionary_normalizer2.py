@@ -6,6 +6,7 @@ import json
 import gzip
 
 import strings
+from dictionary_normalizer import canonicalize
 
 class DictionaryNormalizer2:
 
@@ -30,12 +31,13 @@ class DictionaryNormalizer2:
 		
 		print("Loading name to entity map")
 		start = datetime.datetime.now()
+		postings = dict()
 		if config["name2ids_filename"].endswith(".gz"):
 			with gzip.open(config["name2ids_filename"], "r") as name2ids_file:
-				self.name2ids = {name: set(ids) for name, ids in json.load(name2ids_file).items()}
+				self.name2ids = {name: canonicalize(postings, ids) for name, ids in json.load(name2ids_file).items()}
 		else:
 			with open(config["name2ids_filename"], "r") as name2ids_file:
-				self.name2ids = {name: set(ids) for name, ids in json.load(name2ids_file).items()}
+				self.name2ids = {name: canonicalize(postings, ids) for name, ids in json.load(name2ids_file).items()}
 		print("Loaded " + str(len(self.name2ids)) + " names")
 		print("Elapsed = " + str(datetime.datetime.now() - start))
 		
@@ -91,18 +93,19 @@ class DictionaryNormalizer2:
 		# Load from the cache if it exists
 		if os.path.exists(c_template_cache_filename) and os.path.exists(p_template_cache_filename):
 			print("Loading template to name maps from cache")
+			postings = dict()
 			if c_template_cache_filename.endswith(".gz"):
 				with gzip.open(c_template_cache_filename, "r") as c_template_cache_file:
-					self.c_template2names = {template: set(names) for template, names in json.load(c_template_cache_file).items()}
+					self.c_template2names = {template: canonicalize(postings, names) for template, names in json.load(c_template_cache_file).items()}
 			else:
 				with open(c_template_cache_filename, "r") as c_template_cache_file:
-					self.c_template2names = {template: set(names) for template, names in json.load(c_template_cache_file).items()}
+					self.c_template2names = {template: canonicalize(postings, names) for template, names in json.load(c_template_cache_file).items()}
 			if p_template_cache_filename.endswith(".gz"):
 				with gzip.open(p_template_cache_filename, "r") as p_template_cache_file:
-					self.p_template2names = {template: set(names) for template, names in json.load(p_template_cache_file).items()}
+					self.p_template2names = {template: canonicalize(postings, names) for template, names in json.load(p_template_cache_file).items()}
 			else:
 				with open(p_template_cache_filename, "r") as p_template_cache_file:
-					self.p_template2names = {template: set(names) for template, names in json.load(p_template_cache_file).items()}
+					self.p_template2names = {template: canonicalize(postings, names) for template, names in json.load(p_template_cache_file).items()}
 			return
 
 		self.c_template2names = dict()
@@ -142,7 +145,7 @@ class DictionaryNormalizer2:
 			if name2 in name2ids2:
 				name2ids2[name2].update(id_set)
 			else:
-				name2ids2[name2] = id_set.copy()
+				name2ids2[name2] = set(id_set)
 		# Second pass
 		id2count = dict()
 		id2name = dict()
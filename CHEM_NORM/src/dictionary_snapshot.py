@@ -0,0 +1,351 @@
+import array
+import collections.abc
+import json
+import mmap
+import struct
+import zlib
+
+# Binary snapshot of the DictionaryNormalizer data structures
+# The file is a header followed by named sections, each padded to 8 bytes so it can be viewed in place through mmap
+# All strings are UTF-8, all entity IDs are stored once and referenced by their index in the sorted entity table
+
+MAGIC = b"CHEMNORM"
+VERSION = 5
+NONE = 0xFFFFFFFF
+
+# Bits of the per-entity flags
+TARGET_FLAG = 1
+ALLOWED_FLAG = 2
+
+header_format = "<8sII"
+section_format = "<32sQQ"
+
+class SnapshotWriter:
+
+	def __init__(self):
+		self.sections = list()
+
+	def add(self, name, data):
+		self.sections.append((name, bytes(data)))
+
+	def add_strings(self, name, strings):
+		offsets = array.array("Q", [0])
+		data = bytearray()
+		for string in strings:
+			data.extend(string.encode("utf-8"))
+			offsets.append(len(data))
+		self.add(name + ".offsets", offsets.tobytes())
+		self.add(name + ".data", data)
+
+	def add_index(self, name, strings):
+		# Open addressing hash table with linear probing, slots hold the string index + 1 (0 is empty)
+		size = 2
+		while size < 2 * len(strings):
+			size *= 2
+		mask = size - 1
+		slots = array.array("I", bytes(4 * size))
+		for index, string in enumerate(strings):
+			slot = zlib.crc32(string.encode("utf-8")) & mask
+			while slots[slot] != 0:
+				slot = (slot + 1) & mask
+			slots[slot] = index + 1
+		self.add(name + ".slots", slots.tobytes())
+
+	def add_postings(self, name, postings):
+		offsets = array.array("Q", [0])
+		values = array.array("I")
+		for posting in postings:
+			values.extend(posting)
+			offsets.append(len(values))
+		self.add(name + ".offsets", offsets.tobytes())
+		self.add(name + ".values", values.tobytes())
+
+	def write(self, filename):
+		offset = struct.calcsize(header_format) + len(self.sections) * struct.calcsize(section_format)
+		offset = (offset + 7) & ~7
+		table = list()
+		for name, data in self.sections:
+			table.append((name, offset, len(data)))
+			offset = (offset + len(data) + 7) & ~7
+		with open(filename, "wb") as file:
+			file.write(struct.pack(header_format, MAGIC, VERSION, len(self.sections)))
+			for name, offset, length in table:
+				file.write(struct.pack(section_format, name.encode("ascii"), offset, length))
+			for (name, data), (_, offset, _) in zip(self.sections, table):
+				file.write(bytes(offset - file.tell()))
+				file.write(data)
+
+class StringTable(collections.abc.Sequence):
+
+	def __init__(self, offsets, data, slots = None):
+		self.offsets = offsets
+		self.data = data
+		self.slots = slots
+		if not slots is None:
+			self.mask = len(slots) - 1
+
+	def __len__(self):
+		return len(self.offsets) - 1
+
+	def __getitem__(self, index):
+		return str(self.data[self.offsets[index]:self.offsets[index + 1]], "utf-8")
+
+	def find(self, string):
+		# Returns the index of the string, or -1 if not present
+		key = string.encode("utf-8")
+		slot = zlib.crc32(key) & self.mask
+		while True:
+			index = self.slots[slot]
+			if index == 0:
+				return -1
+			index -= 1
+			if self.data[self.offsets[index]:self.offsets[index + 1]] == key:
+				return index
+			slot = (slot + 1) & self.mask
+
+class PostingTable(collections.abc.Sequence):
+
+	def __init__(self, offsets, values):
+		self.offsets = offsets
+		self.values = values
+
+	def __len__(self):
+		return len(self.offsets) - 1
+
+	def __getitem__(self, index):
+		return self.values[self.offsets[index]:self.offsets[index + 1]]
+
+class PostingMap(collections.abc.Mapping):
+	# Read-only map from the strings in keys to the values of their posting, decoded through values
+	# Without values the posting itself is returned, as a read-only sequence of sorted integers
+
+	def __init__(self, keys, refs, postings, values, count = None):
+		self.keys_table = keys
+		self.refs = refs
+		self.postings = postings
+		self.values_table = values
+		self.count = len(keys) if count is None else count
+
+	def __getitem__(self, key):
+		index = self.keys_table.find(key)
+		if index < 0 or self.refs[index] == NONE:
+			raise KeyError(key)
+		if self.values_table is None:
+			return self.postings[self.refs[index]]
+		return frozenset(self.values_table[value] for value in self.postings[self.refs[index]])
+
+	def __contains__(self, key):
+		index = self.keys_table.find(key)
+		return index >= 0 and self.refs[index] != NONE
+
+	def __iter__(self):
+		for index, key in enumerate(self.keys_table):
+			if self.refs[index] != NONE:
+				yield key
+
+	def __len__(self):
+		return self.count
+
+class ResultMap(collections.abc.Mapping):
+	# Read-only map from the strings in keys to a (frozenset of entities, sieve) result, entities decoded as in PostingMap
+
+	def __init__(self, keys, refs, sieves, postings, values):
+		self.keys_table = keys
+		self.refs = refs
+		self.sieves = sieves
+		self.postings = postings
+		self.values_table = values
+
+	def __getitem__(self, key):
+		index = self.keys_table.find(key)
+		if index < 0:
+			raise KeyError(key)
+		posting = self.postings[self.refs[index]]
+		if self.values_table is None:
+			return frozenset(posting), self.sieves[index]
+		return frozenset(self.values_table[value] for value in posting), self.sieves[index]
+
+	def __iter__(self):
+		return iter(self.keys_table)
+
+	def __len__(self):
+		return len(self.keys_table)
+
+class PostingList(collections.abc.Mapping):
+	# Read-only map from integer indices to their posting
+
+	def __init__(self, refs, postings, count):
+		self.refs = refs
+		self.postings = postings
+		self.count = count
+
+	def __getitem__(self, index):
+		if not index in self:
+			raise KeyError(index)
+		return self.postings[self.refs[index]]
+
+	def __contains__(self, index):
+		return 0 <= index < len(self.refs) and self.refs[index] != NONE
+
+	def __iter__(self):
+		for index, ref in enumerate(self.refs):
+			if ref != NONE:
+				yield index
+
+	def __len__(self):
+		return self.count
+
+class FlagMap(collections.abc.Mapping):
+	# Read-only map from the strings in keys to their aligned flags
+
+	def __init__(self, keys, flags):
+		self.keys_table = keys
+		self.flags = flags
+
+	def __getitem__(self, key):
+		index = self.keys_table.find(key)
+		if index < 0:
+			raise KeyError(key)
+		return self.flags[index]
+
+	def __iter__(self):
+		return iter(self.keys_table)
+
+	def __len__(self):
+		return len(self.keys_table)
+
+class StringMap(collections.abc.Mapping):
+	# Read-only map from the strings in keys to the aligned strings in values, empty values are missing
+
+	def __init__(self, keys, values, count):
+		self.keys_table = keys
+		self.values_table = values
+		self.count = count
+
+	def __getitem__(self, key):
+		index = self.keys_table.find(key)
+		if index >= 0:
+			value = self.values_table[index]
+			if len(value) > 0:
+				return value
+		raise KeyError(key)
+
+	def __iter__(self):
+		for index, key in enumerate(self.keys_table):
+			if len(self.values_table[index]) > 0:
+				yield key
+
+	def __len__(self):
+		return self.count
+
+class DictionarySnapshot:
+
+	def __init__(self, filename):
+		with open(filename, "rb") as file:
+			# The mapping stays valid after the file is closed and is shared between processes
+			self.mmap = mmap.mmap(file.fileno(), 0, access = mmap.ACCESS_READ)
+		magic, version, section_count = struct.unpack_from(header_format, self.mmap, 0)
+		if magic != MAGIC:
+			raise ValueError("Not a dictionary snapshot: " + filename)
+		if version != VERSION:
+			raise ValueError("Dictionary snapshot " + filename + " has version " + str(version) + ", expected " + str(VERSION) + "; recompile it")
+		view = memoryview(self.mmap)
+		self.sections = dict()
+		position = struct.calcsize(header_format)
+		for index in range(section_count):
+			name, offset, length = struct.unpack_from(section_format, self.mmap, position)
+			position += struct.calcsize(section_format)
+			self.sections[name.rstrip(b"\0").decode("ascii")] = view[offset:offset + length]
+		self.meta = json.loads(str(self.sections["meta"], "utf-8"))
+
+		self.entities = self.get_strings("entities")
+		self.names = self.get_strings("names")
+		self.c_templates = self.get_strings("c_templates")
+		self.p_templates = self.get_strings("p_templates")
+		self.flat_names_table = self.get_strings("flat_names")
+		self.flat_templates_table = self.get_strings("flat_templates")
+		self.postings = PostingTable(self.sections["postings.offsets"].cast("Q"), self.sections["postings.values"].cast("I"))
+
+		self.name2ids = PostingMap(self.names, self.sections["names.postings"].cast("I"), self.postings, self.entities)
+		self.c_template2ids = PostingMap(self.c_templates, self.sections["c_templates.postings"].cast("I"), self.postings, self.entities)
+		self.p_template2ids = PostingMap(self.p_templates, self.sections["p_templates.postings"].cast("I"), self.postings, self.entities)
+		self.id2ids = PostingMap(self.entities, self.sections["entities.id2ids"].cast("I"), self.postings, self.entities, self.meta["id2ids_count"])
+		self.flat_names = ResultMap(self.flat_names_table, self.sections["flat_names.postings"].cast("I"), self.sections["flat_names.sieves"], self.postings, self.entities)
+		self.flat_templates = ResultMap(self.flat_templates_table, self.sections["flat_templates.postings"].cast("I"), self.sections["flat_templates.sieves"], self.postings, self.entities)
+		self.entity_flags = FlagMap(self.entities, self.sections["entities.flags"])
+		self.entity_names = StringMap(self.entities, self.get_strings("entities.best_names", False), self.meta["entity_name_count"])
+
+		# Same maps with entities as their index in the entity table
+		self.interned_name2ids = PostingMap(self.names, self.sections["names.postings"].cast("I"), self.postings, None)
+		self.interned_c_template2ids = PostingMap(self.c_templates, self.sections["c_templates.postings"].cast("I"), self.postings, None)
+		self.interned_p_template2ids = PostingMap(self.p_templates, self.sections["p_templates.postings"].cast("I"), self.postings, None)
+		self.interned_id2ids = PostingList(self.sections["entities.id2ids"].cast("I"), self.postings, self.meta["id2ids_count"])
+		self.interned_flat_names = ResultMap(self.flat_names_table, self.sections["flat_names.postings"].cast("I"), self.sections["flat_names.sieves"], self.postings, None)
+		self.interned_flat_templates = ResultMap(self.flat_templates_table, self.sections["flat_templates.postings"].cast("I"), self.sections["flat_templates.sieves"], self.postings, None)
+		self.interned_entity_flags = self.sections["entities.flags"]
+		self.interned_entity_names = self.get_strings("entities.best_names", False)
+
+	def get_strings(self, name, indexed = True):
+		slots = None
+		if indexed:
+			slots = self.sections[name + ".slots"].cast("I")
+		return StringTable(self.sections[name + ".offsets"].cast("Q"), self.sections[name + ".data"], slots)
+
+def write(normalizer, filename, target_resource):
+	if not normalizer.entity_ids is None:
+		raise ValueError("Snapshots are written from a normalizer loaded without intern_ids")
+	if normalizer.flat_names is None:
+		raise ValueError("Snapshots are written from a normalizer with flattened lookup tables")
+	# The metadata table holds every entity ID referenced anywhere, the sorted order makes the integer order match the string order
+	entities = sorted(normalizer.entity_flags)
+	entity2index = {entity: index for index, entity in enumerate(entities)}
+	names = list(normalizer.name2ids)
+	c_templates = list(normalizer.c_template2ids)
+	p_templates = list(normalizer.p_template2ids)
+
+	# Identical postings are stored once and shared by every key that refers to them
+	postings = list()
+	posting2ref = dict()
+	def add_posting(values):
+		posting = tuple(sorted(values))
+		if not posting in posting2ref:
+			posting2ref[posting] = len(postings)
+			postings.append(posting)
+		return posting2ref[posting]
+	name_refs = array.array("I", (add_posting(entity2index[id] for id in normalizer.name2ids[name]) for name in names))
+	c_template_refs = array.array("I", (add_posting(entity2index[id] for id in normalizer.c_template2ids[template]) for template in c_templates))
+	p_template_refs = array.array("I", (add_posting(entity2index[id] for id in normalizer.p_template2ids[template]) for template in p_templates))
+	id2ids_refs = array.array("I", [NONE] * len(entities))
+	for id, ids in normalizer.id2ids.items():
+		id2ids_refs[entity2index[id]] = add_posting(entity2index[id2] for id2 in ids)
+	flat_names = list(normalizer.flat_names)
+	flat_name_refs = array.array("I", (add_posting(entity2index[id] for id in normalizer.flat_names[name][0]) for name in flat_names))
+	flat_name_sieves = bytearray(normalizer.flat_names[name][1] for name in flat_names)
+	flat_templates = list(normalizer.flat_templates)
+	flat_template_refs = array.array("I", (add_posting(entity2index[id] for id in normalizer.flat_templates[key][0]) for key in flat_templates))
+	flat_template_sieves = bytearray(normalizer.flat_templates[key][1] for key in flat_templates)
+	flags = bytearray(normalizer.entity_flags[entity] for entity in entities)
+
+	meta = dict()
+	meta["unknown_id"] = normalizer.unknown_id
+	meta["target_resource"] = target_resource
+	meta["id2ids_count"] = len(normalizer.id2ids)
+	meta["entity_name_count"] = len(normalizer.entity_names)
+
+	writer = SnapshotWriter()
+	writer.add("meta", json.dumps(meta).encode("utf-8"))
+	for name, strings in (("entities", entities), ("names", names), ("c_templates", c_templates), ("p_templates", p_templates), ("flat_names", flat_names), ("flat_templates", flat_templates)):
+		writer.add_strings(name, strings)
+		writer.add_index(name, strings)
+	writer.add_postings("postings", postings)
+	writer.add("names.postings", name_refs.tobytes())
+	writer.add("c_templates.postings", c_template_refs.tobytes())
+	writer.add("p_templates.postings", p_template_refs.tobytes())
+	writer.add("entities.id2ids", id2ids_refs.tobytes())
+	writer.add("flat_names.postings", flat_name_refs.tobytes())
+	writer.add("flat_names.sieves", flat_name_sieves)
+	writer.add("flat_templates.postings", flat_template_refs.tobytes())
+	writer.add("flat_templates.sieves", flat_template_sieves)
+	writer.add("entities.flags", flags)
+	writer.add_strings("entities.best_names", (normalizer.entity_names.get(entity, "") for entity in entities))
+	writer.write(filename)
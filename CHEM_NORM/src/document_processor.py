@@ -1,6 +1,28 @@
 import re
+import xml.etree.ElementTree
 
 from bioc import biocxml
+from bioc.biocxml.encoder import encode_document
+from lxml import etree
+
+import abbreviations
+
+def decode_elements(root, elements):
+	# Decodes a collection holding only the given elements with biocxml, so the objects are the same as from biocxml.load
+	text = "".join([etree.tostring(element, encoding = "unicode", with_tail = False) for element in elements])
+	collection = biocxml.loads("<collection>" + text + "</collection>")
+	docinfo = root.getroottree().docinfo
+	collection.encoding = docinfo.encoding
+	collection.standalone = docinfo.standalone
+	collection.version = docinfo.xml_version
+	return collection
+
+def dumps_document(document, collection):
+	# Serializes the document with the indentation it would have inside the collection written by biocxml.dump
+	wrapper = etree.Element("collection")
+	wrapper.append(encode_document(document))
+	text = etree.tostring(wrapper, pretty_print = True, encoding = collection.encoding, xml_declaration = False).decode(collection.encoding)
+	return text[text.index("\n") + 1:text.rindex("</collection>")]
 
 class DocumentProcessor:
 	# TODO Add timing logs
@@ -8,16 +30,71 @@ class DocumentProcessor:
 	def __init__(self, type2normalizer, abbr):
 		self.type2normalizer = type2normalizer
 		self.abbr = abbr
+		# Optionally take the abbreviations of each document from its own ABBR relations
+		self.abbr_from_input = False
+		# Optionally read, normalize and write one document at a time instead of loading the whole collection
+		self.streaming = False
 	
 	def process_file(self, input_filename, output_filename):
+		if self.streaming:
+			self.process_file_streaming(input_filename, output_filename)
+			return
 		with open(input_filename, "r") as fp:
 			collection = biocxml.load(fp)
 		for document in collection.documents:
 			self.process_document(document)
 		with open(output_filename, "w") as fp:
 			biocxml.dump(collection, fp)
+
+	def process_file_streaming(self, input_filename, output_filename):
+		# Output is the same as process_file, but only the current document is kept in memory
+		root = None
+		collection = None
+		depth = 0
+		with open(output_filename, "w") as fp:
+			for event, element in etree.iterparse(input_filename, events = ("start", "end")):
+				if event == "start":
+					depth += 1
+					if root is None:
+						root = element
+					continue
+				depth -= 1
+				if depth == 1 and element.tag == "document":
+					if collection is None:
+						# The header elements precede the first document
+						collection = self.write_collection_info(root, fp)
+					document = decode_elements(root, [element]).documents[0]
+					# Discard the document, and the header once it has been written
+					root.clear()
+					self.process_document(document)
+					fp.write(dumps_document(document, collection))
+			if collection is None:
+				self.write_collection_info(root, fp)
+			fp.write("</collection>\n")
+
+	def write_collection_info(self, root, fp):
+		# Writes the declaration and header of the collection, leaving it open for the documents
+		collection = decode_elements(root, [child for child in root if child.tag != "document"])
+		header = biocxml.dumps(collection)
+		fp.write(header[:header.rindex("</collection>")])
+		return collection
 		
+	def get_document_ids(self, input_filename):
+		# Returns the IDs of the documents in the file without building the documents
+		document_ids = set()
+		for event, element in xml.etree.ElementTree.iterparse(input_filename):
+			if element.tag == "document":
+				document_ids.add(element.findtext("id"))
+				element.clear()
+		return document_ids
+
 	def process_document(self, document):
+		harvested = False
+		if self.abbr_from_input:
+			# Abbreviations only needed for this document are dropped once it is done
+			harvested = self.abbr.get_document(document.id) is None
+			for document_ID, short, long in abbreviations.read_document(document):
+				self.abbr.add_abbreviation(document_ID, short, long)
 		text2expanded, expanded2lookup = self.extract_mentions(document)
 		#print("expanded2lookup.keys() = " + str(expanded2lookup.keys()))
 		#print("expanded2lookup = " + str(expanded2lookup))
@@ -26,11 +103,14 @@ class DocumentProcessor:
 		#print("expanded2final.keys() = " + str(expanded2final.keys()))
 		#print("expanded2final = " + str(expanded2final))
 		self.apply_lookup(document, text2expanded, expanded2final)
+		if harvested:
+			self.abbr.remove_document(document.id)
 
 	def extract_mentions(self, document):
 		# First pass creates mappings from mention text to expanded text and from expanded text to entities
 		text2expanded = dict()
 		expanded2lookup = dict()
+		type2mentions = dict()
 		for passage in document.passages:
 			for annotation in passage.annotations:
 				if not "type" in annotation.infons:
@@ -48,7 +128,18 @@ class DocumentProcessor:
 					continue
 				print("MENTION\t" + document.id + "\t" + annotation.id + "\t" + entity_type + "\t" + annotation.text + "\t" + text_expanded)
 				normalizer = self.type2normalizer[entity_type]
-				target_entities = normalizer.normalize_mention(text_expanded)
+				if normalizer.trace_lookups:
+					# Look up traced mentions one at a time, so that each LOOKUP line follows its MENTION line
+					expanded2lookup[text_expanded] = ([0], entity_type, normalizer.normalize_mention(text_expanded))
+					continue
+				expanded2lookup[text_expanded] = ([0], entity_type, None)
+				if not entity_type in type2mentions:
+					type2mentions[entity_type] = list()
+				type2mentions[entity_type].append(text_expanded)
+		# Look up all mentions of each type together
+		for entity_type, mention_texts in type2mentions.items():
+			normalizer = self.type2normalizer[entity_type]
+			for text_expanded, target_entities in zip(mention_texts, normalizer.normalize_mentions(mention_texts)):
 				expanded2lookup[text_expanded] = ([0], entity_type, target_entities)
 		return text2expanded, expanded2lookup
 	
@@ -70,14 +161,16 @@ class DocumentProcessor:
 				# TODO Evaluate allowing post-processing to change type
 				entity_type = lookup_tuple[1] 
 				normalizer = self.type2normalizer[entity_type]
-				target_entities = list(lookup_tuple[2])
-				target_entities.sort()
+				# Sorted entities are aligned with their sorted identifiers
+				entities = sorted(lookup_tuple[2])
+				target_entities = normalizer.to_identifiers(entities)
 				names = list()
-				for target_entity in target_entities:
-					if target_entity in normalizer.id2name:
-						names.append(normalizer.id2name[target_entity])
-					else:
+				for entity in entities:
+					name = normalizer.entity_name(entity)
+					if name is None:
 						names.append("UNKNOWN")
+					else:
+						names.append(name)
 				print("NORM\t" + document.id + "\t" + annotation.text + "\t" + text_expanded + "\t" + str(processing_path) + "\t" + str(len(target_entities)) + "\t" + str(target_entities) + "\t" + str(names))
 				if len(target_entities) > 0:
 					identifier = ",".join(target_entities)
@@ -107,43 +200,44 @@ class DocumentProcessor:
 			elif len(target_entities) == 0: 
 				# No matches => Unknown
 				processing_path.append(2)
-				id = {normalizer.unknown_id}
-				expanded2final[text_expanded] = (processing_path, entity_type, {normalizer.unknown_id})
+				id = {normalizer.unknown_entity}
+				expanded2final[text_expanded] = (processing_path, entity_type, {normalizer.unknown_entity})
 				print("POST\t" + document_id + "\t" + text_expanded + "\t" + str(processing_path) + "\tUNKNOWN")
 			elif len(target_entities) == 1: 
 				# Unambiguous
 				unambiguous_entities.update(target_entities)
 				processing_path.append(3)
 				expanded2lookup2[text_expanded] = (processing_path, entity_type, target_entities)
-				print("POST\t" + document_id + "\t" + text_expanded + "\t" + str(processing_path) + "\t" + str(target_entities) + "\tUNAMBIGUOUS")
+				print("POST\t" + document_id + "\t" + text_expanded + "\t" + str(processing_path) + "\t" + normalizer.format_entities(target_entities) + "\tUNAMBIGUOUS")
 			else:
 				# Ambiguous
 				processing_path.append(4)
 				expanded2lookup2[text_expanded] = (processing_path, entity_type, target_entities)
-				print("POST\t" + document_id + "\t" + text_expanded + "\t" + str(processing_path) + "\t" + str(target_entities) + "\tAMBIGUOUS")
+				print("POST\t" + document_id + "\t" + text_expanded + "\t" + str(processing_path) + "\t" + normalizer.format_entities(target_entities) + "\tAMBIGUOUS")
 		# Resolve ambiguous
 		expanded2lookup = expanded2lookup2
 		expanded2lookup2 = dict()
 		for text_expanded, lookup_tuple in expanded2lookup.items():
 			processing_path = lookup_tuple[0]
 			entity_type = lookup_tuple[1]
+			normalizer = self.type2normalizer[entity_type]
 			target_entities = lookup_tuple[2]
 			if len(target_entities) == 1:
 				# Not ambiguous
 				processing_path.append(5)
 				expanded2lookup2[text_expanded] = (processing_path, entity_type, target_entities)
-				print("POST\t" + document_id + "\t" + text_expanded + "\t" + str(processing_path) + "\t" + str(target_entities) + "\tUNAMBIGUOUS")
+				print("POST\t" + document_id + "\t" + text_expanded + "\t" + str(processing_path) + "\t" + normalizer.format_entities(target_entities) + "\tUNAMBIGUOUS")
 			else:
 				resolved = target_entities.intersection(unambiguous_entities)
 				if len(resolved) == 0:
 					# Fall back to the target entities
 					processing_path.append(6)
 					expanded2lookup2[text_expanded] = (processing_path, entity_type, target_entities)
-					print("POST\t" + document_id + "\t" + text_expanded + "\t" + str(processing_path) + "\t" + str(resolved) + "\tFALLBACK")
+					print("POST\t" + document_id + "\t" + text_expanded + "\t" + str(processing_path) + "\t" + normalizer.format_entities(resolved) + "\tFALLBACK")
 				else:
 					processing_path.append(7)
 					expanded2lookup2[text_expanded] = (processing_path, entity_type, resolved)
-					print("POST\t" + document_id + "\t" + text_expanded + "\t" + str(processing_path) + "\t" + str(resolved) + "\tRESOLVED")
+					print("POST\t" + document_id + "\t" + text_expanded + "\t" + str(processing_path) + "\t" + normalizer.format_entities(resolved) + "\tRESOLVED")
 		# Filter non-allowed, map to unknown if still ambiguous
 		expanded2lookup = expanded2lookup2
 		for text_expanded, lookup_tuple in expanded2lookup.items():
@@ -151,15 +245,15 @@ class DocumentProcessor:
 			entity_type = lookup_tuple[1]
 			target_entities = lookup_tuple[2]
 			normalizer = self.type2normalizer[entity_type]
-			resolved = target_entities.intersection(normalizer.allowed_ids)
+			resolved = {entity for entity in target_entities if normalizer.is_allowed(entity)}
 			if resolved != target_entities:
 				# Some non-allowed ids removed
 				processing_path.append(8)
-				print("POST\t" + document_id + "\t" + text_expanded + "\t" + str(processing_path) + "\t" + str(resolved) + "\tREMNALLOW")
+				print("POST\t" + document_id + "\t" + text_expanded + "\t" + str(processing_path) + "\t" + normalizer.format_entities(resolved) + "\tREMNALLOW")
 			if len(resolved) > 1:
 				# Still ambiguous
-				resolved = {normalizer.unknown_id}
+				resolved = {normalizer.unknown_entity}
 				processing_path.append(9)
-				print("POST\t" + document_id + "\t" + text_expanded + "\t" + str(processing_path) + "\t" + str(resolved) + "\tSTILLAMBIG")
+				print("POST\t" + document_id + "\t" + text_expanded + "\t" + str(processing_path) + "\t" + normalizer.format_entities(resolved) + "\tSTILLAMBIG")
 			expanded2final[text_expanded] = (processing_path, entity_type, resolved)
 		return expanded2final
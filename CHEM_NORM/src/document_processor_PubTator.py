@@ -1,6 +1,20 @@
-import codecs
 import re
 
+import file_ranges
+
+# Size of the output buffer, documents are small so many are written at once
+output_buffer_size = 1 << 20
+
+def get_marker(line):
+	# Returns the "|t|" or "|a|" that follows the document ID, annotation lines have a tab first
+	index = line.find("|")
+	if index < 0:
+		return None
+	tab_index = line.find("\t", 0, index)
+	if tab_index > -1:
+		return None
+	return line[index:index + 3]
+
 class PubTatorDocument:
 	
 	def __init__(self):
@@ -23,25 +37,39 @@ class PubTatorDocumentProcessor:
 	def __init__(self, type2normalizer, abbr):
 		self.type2normalizer = type2normalizer
 		self.abbr = abbr
+		# Optional (start, end) byte range of the input file to process
+		self.input_range = None
 	
 	def process_file(self, input_filename, output_filename):
-		documents = list()
-		with codecs.open(input_filename, 'r', encoding="utf-8") as input_file:
+		# Each document is written as soon as it is processed, so only the current document is kept in memory
+		with open(output_filename, "w", encoding="utf-8", newline="\n", buffering=output_buffer_size) as output_file:
+			for document in self.read_documents(input_filename):
+				self.process_document(document)
+				output_file.write("{}|t|{}\n".format(document.id, document.title))
+				output_file.write("{}|a|{}\n".format(document.id, document.abstract))
+				for annotation in document.annotations:
+					output_file.write("{}\t{}\t{}\t{}\t{}\t{}\n".format(document.id, annotation.start, annotation.end, annotation.text, annotation.type, annotation.identifier))
+				output_file.write("\n")
+
+	def read_documents(self, input_filename):
+		# Yields each document once its last line has been read
+		with file_ranges.open_input(input_filename, self.input_range) as input_file:
 			current_document = None
 			for line in input_file:
 				line = line.strip()
 				if len(line) == 0:
 					continue
-				if line.find("|t|") > -1:
+				marker = get_marker(line)
+				if marker == "|t|":
 					# Handle previous document
 					if not current_document is None:
-						documents.append(current_document)
+						yield current_document
 					current_document = PubTatorDocument()
 					# Handle title
 					fields = line.split("|")
 					current_document.id = fields[0]
 					current_document.title = fields[2]
-				elif line.find("|a|") > -1:
+				elif marker == "|a|":
 					# Handle abstract
 					fields = line.split("|")
 					current_document.abstract = fields[2]
@@ -56,16 +84,22 @@ class PubTatorDocumentProcessor:
 					if annotation.type in self.type2normalizer:
 						current_document.annotations.append(annotation)
 			if not current_document is None:
-				documents.append(current_document)
-		with codecs.open(output_filename, 'w', encoding="utf-8") as output_file:
-			for document in documents:
-				self.process_document(document)
-				output_file.write("{}|t|{}\n".format(document.id, document.title))
-				output_file.write("{}|a|{}\n".format(document.id, document.abstract))
-				for annotation in document.annotations:
-					output_file.write("{}\t{}\t{}\t{}\t{}\t{}\n".format(document.id, annotation.start, annotation.end, annotation.text, annotation.type, annotation.identifier))
-				output_file.write("\n")
+				yield current_document
 				
+	def get_ranges(self, input_filename, parts):
+		# Splits the input into byte ranges that each start at a title line
+		return file_ranges.find_ranges(input_filename, parts, lambda previous, line: get_marker(line.decode("utf-8", "replace").strip()) == "|t|")
+
+	def get_document_ids(self, input_filename):
+		# Returns the IDs of the documents in the file without processing them
+		document_ids = set()
+		with open(input_filename, "r", encoding="utf-8") as input_file:
+			for line in input_file:
+				line = line.strip()
+				if get_marker(line) == "|t|":
+					document_ids.add(line.split("|")[0])
+		return document_ids
+
 	def process_document(self, document):
 		text2expanded, expanded2lookup = self.extract_mentions(document)
 		#print("expanded2lookup.keys() = " + str(expanded2lookup.keys()))
@@ -80,6 +114,7 @@ class PubTatorDocumentProcessor:
 		# First pass creates mappings from mention text to expanded text and from expanded text to entities
 		text2expanded = dict()
 		expanded2lookup = dict()
+		type2mentions = dict()
 		for annotation in document.annotations:
 			entity_type = annotation.type
 			if not entity_type in self.type2normalizer:
@@ -94,8 +129,19 @@ class PubTatorDocumentProcessor:
 				continue
 			print("MENTION\t" + document.id + "\t" + entity_type + "\t" + annotation.text + "\t" + text_expanded)
 			normalizer = self.type2normalizer[entity_type]
-			target_entities = normalizer.normalize_mention(text_expanded)
-			expanded2lookup[text_expanded] = ([0], entity_type, target_entities)
+			if normalizer.trace_lookups:
+				# Look up traced mentions one at a time, so that each LOOKUP line follows its MENTION line
+				expanded2lookup[text_expanded] = ([0], entity_type, normalizer.normalize_mention(text_expanded))
+				continue
+			expanded2lookup[text_expanded] = ([0], entity_type, None)
+			if not entity_type in type2mentions:
+				type2mentions[entity_type] = list()
+			type2mentions[entity_type].append(text_expanded)
+		# Look up all mentions of each type together
+		for entity_type, mention_texts in type2mentions.items():
+			normalizer = self.type2normalizer[entity_type]
+			for text_expanded, target_entities in zip(mention_texts, normalizer.normalize_mentions(mention_texts)):
+				expanded2lookup[text_expanded] = ([0], entity_type, target_entities)
 		return text2expanded, expanded2lookup
 	
 	def apply_lookup(self, document, text2expanded, expanded2final):
@@ -113,14 +159,16 @@ class PubTatorDocumentProcessor:
 			# TODO Evaluate allowing post-processing to change type
 			entity_type = lookup_tuple[1] 
 			normalizer = self.type2normalizer[entity_type]
-			target_entities = list(lookup_tuple[2])
-			target_entities.sort()
+			# Sorted entities are aligned with their sorted identifiers
+			entities = sorted(lookup_tuple[2])
+			target_entities = normalizer.to_identifiers(entities)
 			names = list()
-			for target_entity in target_entities:
-				if target_entity in normalizer.id2name:
-					names.append(normalizer.id2name[target_entity])
-				else:
+			for entity in entities:
+				name = normalizer.entity_name(entity)
+				if name is None:
 					names.append("UNKNOWN")
+				else:
+					names.append(name)
 			print("NORM\t" + document.id + "\t" + annotation.text + "\t" + text_expanded + "\t" + str(processing_path) + "\t" + str(len(target_entities)) + "\t" + str(target_entities) + "\t" + str(names))
 			if len(target_entities) > 0:
 				annotation.identifier = ",".join(target_entities)
@@ -145,7 +193,7 @@ class PubTatorDocumentProcessor:
 			elif len(target_entities) == 0: 
 				# Mo matches => Unknown
 				processing_path.append(2)
-				expanded2final[text_expanded] = (processing_path, entity_type, {normalizer.unknown_id})
+				expanded2final[text_expanded] = (processing_path, entity_type, {normalizer.unknown_entity})
 			elif len(target_entities) == 1: 
 				# Unambiguous
 				unambiguous_entities.update(target_entities)
@@ -182,13 +230,13 @@ class PubTatorDocumentProcessor:
 			entity_type = lookup_tuple[1]
 			target_entities = lookup_tuple[2]
 			normalizer = self.type2normalizer[entity_type]
-			resolved = target_entities.intersection(normalizer.allowed_ids)
+			resolved = {entity for entity in target_entities if normalizer.is_allowed(entity)}
 			if resolved != target_entities:
 				# Some non-allowed ids removed
 				processing_path.append(8)
 			if len(resolved) > 1:
 				# Still ambiguous
-				resolved = {normalizer.unknown_id}
+				resolved = {normalizer.unknown_entity}
 				processing_path.append(9)
 			expanded2final[text_expanded] = (processing_path, entity_type, resolved)
 		return expanded2final
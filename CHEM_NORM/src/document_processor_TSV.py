@@ -1,5 +1,45 @@
-import codecs
+import heapq
+import os
 import re
+import tempfile
+
+import file_ranges
+
+# How the annotations are grouped into documents
+# All three give the same output
+# memory: all documents are kept in memory
+# sorted: the rows of each document must be contiguous, each document is processed when its rows end
+# spill: rows are partitioned by document ID into temporary files, which are processed one at a time
+tsv_modes = {"memory", "sorted", "spill"}
+
+def format_document(document):
+	text = "".join(["{}\t{}\t{}\t{}\t{}\t{}\n".format(document.id, annotation.start, annotation.end, annotation.text, annotation.type, annotation.identifier) for annotation in document.annotations])
+	return text + "\n"
+
+def read_bucket(bucket_filename):
+	# Yields the line number of the first row and the document for each document in a spill bucket, in order of their first row
+	documents = dict()
+	with open(bucket_filename, "r", encoding="utf-8", newline="\n") as bucket_file:
+		for line in bucket_file:
+			fields = line[:-1].split("\t")
+			docid = fields[1]
+			annotation = TSVAnnotation()
+			annotation.start = int(fields[2])
+			annotation.end = int(fields[3])
+			annotation.text = fields[4]
+			annotation.type = fields[5]
+			if not docid in documents:
+				documents[docid] = (int(fields[0]), TSVDocument(docid))
+			documents[docid][1].annotations.append(annotation)
+	yield from documents.values()
+
+def read_processed(processed_filename):
+	# Yields the line number of the first row and the output text of each processed document
+	with open(processed_filename, "r", encoding="utf-8", newline="\n") as processed_file:
+		for line in processed_file:
+			fields = line.split("\t")
+			text = "".join([processed_file.readline() for index in range(int(fields[1]))])
+			yield int(fields[0]), text
 
 class TSVDocument:
 	
@@ -21,11 +61,32 @@ class TSVDocumentProcessor:
 	def __init__(self, type2normalizer, abbr):
 		self.type2normalizer = type2normalizer
 		self.abbr = abbr
+		self.mode = "memory"
+		# Number of temporary files and where they are created in spill mode, None is the system default
+		self.spill_buckets = 64
+		self.spill_directory = None
+		# Optional (start, end) byte range of the input file to process
+		self.input_range = None
 	
 	def process_file(self, input_filename, output_filename):
-		documents = dict()
-		with codecs.open(input_filename, 'r', encoding="utf-8") as input_file:
-			for line in input_file:
+		if not self.mode in tsv_modes:
+			raise ValueError("Unknown TSV mode: " + str(self.mode))
+		if self.mode == "spill":
+			self.process_file_spill(input_filename, output_filename)
+			return
+		if self.mode == "sorted":
+			documents = self.read_sorted_documents(input_filename)
+		else:
+			documents = self.read_documents(input_filename)
+		with open(output_filename, "w", encoding="utf-8", newline="\n") as output_file:
+			for document in documents:
+				self.process_document(document)
+				output_file.write(format_document(document))
+
+	def read_annotations(self, input_filename):
+		# Yields the line number, document ID and annotation of each row with a type that is normalized
+		with file_ranges.open_input(input_filename, self.input_range) as input_file:
+			for line_number, line in enumerate(input_file):
 				line = line.strip()
 				if len(line) == 0:
 					continue
@@ -38,16 +99,75 @@ class TSVDocumentProcessor:
 				annotation.text = fields[3]
 				annotation.type = fields[4]
 				if annotation.type in self.type2normalizer:
-					if not docid in documents:
-						documents[docid] = TSVDocument(docid)
-					documents[docid].annotations.append(annotation)
-		with codecs.open(output_filename, 'w', encoding="utf-8") as output_file:
-			for document in documents.values():
-				self.process_document(document)
-				for annotation in document.annotations:
-					output_file.write("{}\t{}\t{}\t{}\t{}\t{}\n".format(document.id, annotation.start, annotation.end, annotation.text, annotation.type, annotation.identifier))
-				output_file.write("\n")
-				
+					yield line_number, docid, annotation
+
+	def read_documents(self, input_filename):
+		# Returns the documents in order of their first row
+		documents = dict()
+		for line_number, docid, annotation in self.read_annotations(input_filename):
+			if not docid in documents:
+				documents[docid] = TSVDocument(docid)
+			documents[docid].annotations.append(annotation)
+		return documents.values()
+
+	def read_sorted_documents(self, input_filename):
+		# Yields each document as soon as its rows end
+		# The IDs of finished documents are kept to detect input that is not sorted
+		finished = set()
+		document = None
+		for line_number, docid, annotation in self.read_annotations(input_filename):
+			if document is None or document.id != docid:
+				if not document is None:
+					finished.add(document.id)
+					yield document
+				if docid in finished:
+					raise ValueError("Input is not sorted by document ID, rows for document " + docid + " continue at line " + str(line_number + 1))
+				document = TSVDocument(docid)
+			document.annotations.append(annotation)
+		if not document is None:
+			yield document
+
+	def process_file_spill(self, input_filename, output_filename):
+		with tempfile.TemporaryDirectory(dir = self.spill_directory) as directory:
+			# Partition the rows by document ID, keeping the line number of each row
+			bucket_filenames = [os.path.join(directory, "bucket" + str(index) + ".tsv") for index in range(self.spill_buckets)]
+			bucket_files = [open(filename, "w", encoding="utf-8", newline="\n") for filename in bucket_filenames]
+			for line_number, docid, annotation in self.read_annotations(input_filename):
+				bucket_files[hash(docid) % self.spill_buckets].write("{}\t{}\t{}\t{}\t{}\t{}\n".format(line_number, docid, annotation.start, annotation.end, annotation.text, annotation.type))
+			for bucket_file in bucket_files:
+				bucket_file.close()
+			# Process each bucket, writing the documents with the line number of their first row
+			processed_filenames = list()
+			for bucket_filename in bucket_filenames:
+				processed_filename = bucket_filename + ".out"
+				with open(processed_filename, "w", encoding="utf-8", newline="\n") as processed_file:
+					for first_line_number, document in read_bucket(bucket_filename):
+						self.process_document(document)
+						text = format_document(document)
+						processed_file.write("{}\t{}\n".format(first_line_number, text.count("\n")))
+						processed_file.write(text)
+				os.remove(bucket_filename)
+				processed_filenames.append(processed_filename)
+			# Merge the buckets back into the order of the first row of each document
+			with open(output_filename, "w", encoding="utf-8", newline="\n") as output_file:
+				for first_line_number, text in heapq.merge(*[read_processed(filename) for filename in processed_filenames]):
+					output_file.write(text)
+
+	def get_ranges(self, input_filename, parts):
+		# Splits the input into byte ranges that each start where the document ID changes
+		# The output is the same as for the whole file if the rows of each document are contiguous
+		return file_ranges.find_ranges(input_filename, parts, lambda previous, line: not previous is None and previous.strip().split(b"\t")[0] != line.strip().split(b"\t")[0])
+
+	def get_document_ids(self, input_filename):
+		# Returns the IDs of the documents in the file without processing them
+		document_ids = set()
+		with open(input_filename, "r", encoding="utf-8") as input_file:
+			for line in input_file:
+				line = line.strip()
+				if len(line) > 0:
+					document_ids.add(line.split("\t")[0])
+		return document_ids
+
 	def process_document(self, document):
 		text2expanded, expanded2lookup = self.extract_mentions(document)
 		#print("expanded2lookup.keys() = " + str(expanded2lookup.keys()))
@@ -62,6 +182,7 @@ class TSVDocumentProcessor:
 		# First pass creates mappings from mention text to expanded text and from expanded text to entities
 		text2expanded = dict()
 		expanded2lookup = dict()
+		type2mentions = dict()
 		for annotation in document.annotations:
 			entity_type = annotation.type
 			if not entity_type in self.type2normalizer:
@@ -76,8 +197,19 @@ class TSVDocumentProcessor:
 				continue
 			print("MENTION\t" + document.id + "\t" + entity_type + "\t" + annotation.text + "\t" + text_expanded)
 			normalizer = self.type2normalizer[entity_type]
-			target_entities = normalizer.normalize_mention(text_expanded)
-			expanded2lookup[text_expanded] = ([0], entity_type, target_entities)
+			if normalizer.trace_lookups:
+				# Look up traced mentions one at a time, so that each LOOKUP line follows its MENTION line
+				expanded2lookup[text_expanded] = ([0], entity_type, normalizer.normalize_mention(text_expanded))
+				continue
+			expanded2lookup[text_expanded] = ([0], entity_type, None)
+			if not entity_type in type2mentions:
+				type2mentions[entity_type] = list()
+			type2mentions[entity_type].append(text_expanded)
+		# Look up all mentions of each type together
+		for entity_type, mention_texts in type2mentions.items():
+			normalizer = self.type2normalizer[entity_type]
+			for text_expanded, target_entities in zip(mention_texts, normalizer.normalize_mentions(mention_texts)):
+				expanded2lookup[text_expanded] = ([0], entity_type, target_entities)
 		return text2expanded, expanded2lookup
 	
 	def apply_lookup(self, document, text2expanded, expanded2final):
@@ -95,14 +227,16 @@ class TSVDocumentProcessor:
 			# TODO Evaluate allowing post-processing to change type
 			entity_type = lookup_tuple[1] 
 			normalizer = self.type2normalizer[entity_type]
-			target_entities = list(lookup_tuple[2])
-			target_entities.sort()
+			# Sorted entities are aligned with their sorted identifiers
+			entities = sorted(lookup_tuple[2])
+			target_entities = normalizer.to_identifiers(entities)
 			names = list()
-			for target_entity in target_entities:
-				if target_entity in normalizer.id2name:
-					names.append(normalizer.id2name[target_entity])
-				else:
+			for entity in entities:
+				name = normalizer.entity_name(entity)
+				if name is None:
 					names.append("UNKNOWN")
+				else:
+					names.append(name)
 			print("NORM\t" + document.id + "\t" + annotation.text + "\t" + text_expanded + "\t" + str(processing_path) + "\t" + str(len(target_entities)) + "\t" + str(target_entities) + "\t" + str(names))
 			if len(target_entities) > 0:
 				annotation.identifier = ",".join(target_entities)
@@ -127,7 +261,7 @@ class TSVDocumentProcessor:
 			elif len(target_entities) == 0: 
 				# Mo matches => Unknown
 				processing_path.append(2)
-				expanded2final[text_expanded] = (processing_path, entity_type, {normalizer.unknown_id})
+				expanded2final[text_expanded] = (processing_path, entity_type, {normalizer.unknown_entity})
 			elif len(target_entities) == 1: 
 				# Unambiguous
 				unambiguous_entities.update(target_entities)
@@ -164,13 +298,13 @@ class TSVDocumentProcessor:
 			entity_type = lookup_tuple[1]
 			target_entities = lookup_tuple[2]
 			normalizer = self.type2normalizer[entity_type]
-			resolved = target_entities.intersection(normalizer.allowed_ids)
+			resolved = {entity for entity in target_entities if normalizer.is_allowed(entity)}
 			if resolved != target_entities:
 				# Some non-allowed ids removed
 				processing_path.append(8)
 			if len(resolved) > 1:
 				# Still ambiguous
-				resolved = {normalizer.unknown_id}
+				resolved = {normalizer.unknown_entity}
 				processing_path.append(9)
 			expanded2final[text_expanded] = (processing_path, entity_type, resolved)
 		return expanded2final
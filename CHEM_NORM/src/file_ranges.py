@@ -0,0 +1,66 @@
+import io
+import os
+
+# Splits a single large input file into byte ranges that start at document boundaries, so the ranges can be processed separately
+
+class FileRange(io.RawIOBase):
+	# Reads the bytes of a file from start up to end
+
+	def __init__(self, filename, start, end):
+		self.file = open(filename, "rb", buffering = 0)
+		self.file.seek(start)
+		self.remaining = end - start
+
+	def readable(self):
+		return True
+
+	def readinto(self, buffer):
+		if self.remaining <= 0:
+			return 0
+		with memoryview(buffer) as view:
+			size = self.file.readinto(view[:self.remaining])
+		self.remaining -= size
+		return size
+
+	def close(self):
+		self.file.close()
+		super().close()
+
+def open_input(filename, input_range = None):
+	# Opens the input as text, either the whole file or only the (start, end) byte range
+	if input_range is None:
+		return open(filename, "r", encoding="utf-8")
+	start, end = input_range
+	return io.TextIOWrapper(io.BufferedReader(FileRange(filename, start, end)), encoding="utf-8")
+
+def find_ranges(filename, parts, is_document_start):
+	# Returns up to parts (start, end) byte ranges of roughly equal size
+	# Each range starts at a line for which is_document_start(previous, line) is true, given the previous non-blank line (None for the first line read)
+	size = os.path.getsize(filename)
+	starts = [0]
+	with open(filename, "rb") as file:
+		for part in range(1, parts):
+			position = size * part // parts
+			if position <= starts[-1]:
+				continue
+			# Skip to the first complete line
+			file.seek(position - 1)
+			file.readline()
+			previous = None
+			start = None
+			while start is None:
+				line_start = file.tell()
+				line = file.readline()
+				if len(line) == 0:
+					break
+				if len(line.strip()) == 0:
+					continue
+				if is_document_start(previous, line):
+					start = line_start
+				previous = line
+			if start is None:
+				# The rest of the file is a single document
+				break
+			starts.append(start)
+	ends = starts[1:] + [size]
+	return [(start, end) for start, end in zip(starts, ends) if end > start]
@@ -0,0 +1,24 @@
+import datetime
+import os
+import sys
+
+import abbreviations
+
+# Writes the abbreviations from TSV or BioC XML files into an SQLite index that normalize.py reads one document at a time
+# The rows keep their original order, so the expansions are the same as when loading the files directly
+
+if __name__ == "__main__":
+	start = datetime.datetime.now()
+	if len(sys.argv) != 3:
+		print("Usage: <abbreviations> <index>")
+		exit()
+	abbr_path = sys.argv[1]
+	index_filename = sys.argv[2]
+	if not index_filename.endswith(".db"):
+		raise ValueError("Index filename must end in .db: " + index_filename)
+	if os.path.exists(index_filename):
+		raise RuntimeError("Index already exists: " + index_filename)
+
+	abbreviations.write_index(abbr_path, index_filename)
+	print("Total time = " + str(datetime.datetime.now() - start))
+	print("Done.")
@@ -0,0 +1,39 @@
+import collections
+
+class MentionCache:
+	# Least recently used cache of mention lookup results, with usage statistics
+
+	def __init__(self, capacity):
+		self.capacity = capacity
+		self.entries = collections.OrderedDict()
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+
+	def __len__(self):
+		return len(self.entries)
+
+	def get(self, key):
+		entry = self.entries.get(key)
+		if entry is None:
+			self.misses += 1
+			return None
+		self.entries.move_to_end(key)
+		self.hits += 1
+		return entry
+
+	def put(self, key, entry):
+		if self.capacity <= 0:
+			return
+		self.entries[key] = entry
+		self.entries.move_to_end(key)
+		if len(self.entries) > self.capacity:
+			self.entries.popitem(last = False)
+			self.evictions += 1
+
+	def report(self):
+		lookups = self.hits + self.misses
+		hit_rate = 0.0
+		if lookups > 0:
+			hit_rate = 100.0 * self.hits / lookups
+		print("Mention cache hits = {}, misses = {}, evictions = {}, size = {}, capacity = {}, hit rate = {:.1f}%".format(self.hits, self.misses, self.evictions, len(self.entries), self.capacity, hit_rate))
@@ -1,13 +1,18 @@
+import collections
 import datetime
 import json
+import multiprocessing
 import os  
+import shutil
 import sys
+import tempfile
 
 from abbreviations import AbbreviationExpander
-from dictionary_normalizer import DictionaryNormalizer
+from dictionary_normalizer import DictionaryNormalizer, dictionary_fingerprint
 from document_processor import DocumentProcessor
 from document_processor_PubTator import PubTatorDocumentProcessor
-from document_processor_TSV import TSVDocumentProcessor
+from document_processor_TSV import TSVDocumentProcessor, tsv_modes
+import strings
 
 def target_MESH(resource, accession):
 	return resource == "MESH" and not accession.startswith("Q")
@@ -24,17 +29,154 @@ target2filter["MESH"] = target_MESH
 target2filter["CHEBI"] = target_CHEBI
 target2filter["MONDO"] = target_MONDO
 
+# Document processor used by the worker processes, inherited when they are forked
+worker_processor = None
+
+def init_worker(doc_processor, log_directory = None):
+	global worker_processor
+	worker_processor = doc_processor
+	doc_processor.abbr.reopen_store()
+	if not log_directory is None:
+		# Each worker writes its own log, so the logs of different files are not interleaved
+		sys.stdout = open(os.path.join(log_directory, "worker" + str(os.getpid()) + ".log"), "w")
+
+def get_counts(doc_processor):
+	# Returns the mention cache statistics of each normalizer and the Unicode characters that could not be mapped so far
+	type2cache_counts = dict()
+	for entity_type, normalizer in doc_processor.type2normalizer.items():
+		type2cache_counts[entity_type] = (normalizer.mention_cache.hits, normalizer.mention_cache.misses, normalizer.mention_cache.evictions)
+	return type2cache_counts, collections.Counter(strings.missing_unicode)
+
+def process_task(task):
+	# Processes a file, or a byte range of it, in a worker and returns what was added to its counts
+	input_filename, input_range, output_filename = task
+	start = datetime.datetime.now()
+	type2cache_counts, missing_unicode = get_counts(worker_processor)
+	if not input_range is None:
+		worker_processor.input_range = input_range
+	print("Processing file " + input_filename + " to " + output_filename)
+	worker_processor.process_file(input_filename, output_filename)
+	sys.stdout.flush()
+	type2new_cache_counts, new_missing_unicode = get_counts(worker_processor)
+	type2cache_deltas = dict()
+	for entity_type, cache_counts in type2cache_counts.items():
+		type2cache_deltas[entity_type] = [new_count - count for new_count, count in zip(type2new_cache_counts[entity_type], cache_counts)]
+	return os.getpid(), input_filename, output_filename, datetime.datetime.now() - start, type2cache_deltas, new_missing_unicode - missing_unicode
+
+def add_counts(doc_processor, type2cache_deltas, missing_unicode):
+	# Adds the counts of a worker, so the reports at the end cover all processes
+	for entity_type, (hits, misses, evictions) in type2cache_deltas.items():
+		mention_cache = doc_processor.type2normalizer[entity_type].mention_cache
+		mention_cache.hits += hits
+		mention_cache.misses += misses
+		mention_cache.evictions += evictions
+	strings.missing_unicode.update(missing_unicode)
+
+def process_split(doc_processor, input_filename, output_filename, parts):
+	# Processes byte ranges of the file in parallel and concatenates their output in order
+	input_ranges = doc_processor.get_ranges(input_filename, parts)
+	print("Split " + input_filename + " into " + str(len(input_ranges)) + " ranges")
+	if len(input_ranges) < 2:
+		doc_processor.process_file(input_filename, output_filename)
+		return
+	with tempfile.TemporaryDirectory(dir = os.path.dirname(os.path.abspath(output_filename))) as directory:
+		tasks = [(input_filename, input_range, os.path.join(directory, "part" + str(index))) for index, input_range in enumerate(input_ranges)]
+		# Output still buffered would otherwise be written again by the workers
+		sys.stdout.flush()
+		context = multiprocessing.get_context("fork")
+		with context.Pool(len(tasks), init_worker, (doc_processor,)) as pool:
+			results = pool.map(process_task, tasks)
+		with open(output_filename, "wb") as output_file:
+			for pid, range_filename, part_filename, elapsed, type2cache_deltas, missing_unicode in results:
+				add_counts(doc_processor, type2cache_deltas, missing_unicode)
+				with open(part_filename, "rb") as part_file:
+					shutil.copyfileobj(part_file, output_file)
+
+def process_directory(doc_processor, tasks, workers):
+	# Processes the files in forked worker processes, each taking the next file as soon as it is done with one
+	pid2files = dict()
+	pid2elapsed = dict()
+	with tempfile.TemporaryDirectory() as log_directory:
+		sys.stdout.flush()
+		context = multiprocessing.get_context("fork")
+		with context.Pool(workers, init_worker, (doc_processor, log_directory)) as pool:
+			for pid, input_filename, output_filename, elapsed, type2cache_deltas, missing_unicode in pool.imap_unordered(process_task, tasks):
+				print("Processed file " + input_filename + " to " + output_filename + " in worker " + str(pid) + ", elapsed = " + str(elapsed))
+				add_counts(doc_processor, type2cache_deltas, missing_unicode)
+				pid2files[pid] = pid2files.get(pid, 0) + 1
+				pid2elapsed[pid] = pid2elapsed.get(pid, datetime.timedelta()) + elapsed
+		for pid in sorted(pid2files):
+			print("Log of worker " + str(pid))
+			with open(os.path.join(log_directory, "worker" + str(pid) + ".log")) as log_file:
+				shutil.copyfileobj(log_file, sys.stdout)
+	print("Processed " + str(len(tasks)) + " files with " + str(workers) + " workers")
+	for pid in sorted(pid2files):
+		print("Worker " + str(pid) + " processed " + str(pid2files[pid]) + " files, elapsed = " + str(pid2elapsed[pid]))
+
+# Options may precede the positional arguments, mapped to whether they take a value
+option2value = dict()
+option2value["--mention_cache"] = True
+option2value["--abbr_prefilter"] = False
+option2value["--abbr_from_input"] = False
+option2value["--abbr_workers"] = True
+option2value["--streaming"] = False
+option2value["--tsv_mode"] = True
+option2value["--split"] = True
+option2value["--workers"] = True
+
+def parse_options(args):
+	options = dict()
+	index = 0
+	while index < len(args) and args[index].startswith("--"):
+		option = args[index]
+		if not option in option2value:
+			raise ValueError("Unknown option: " + option)
+		if option2value[option]:
+			if index + 1 >= len(args):
+				raise ValueError("Option requires a value: " + option)
+			options[option] = args[index + 1]
+			index += 2
+		else:
+			options[option] = True
+			index += 1
+	return options, args[index:]
+
 if __name__ == "__main__":
 	# TODO Allow multiple config files, to handle multiple entity types
 	start = datetime.datetime.now()
-	if len(sys.argv) != 6:
-		print("Usage: <config> <format> <abbreviations> <input> <output>")
+	options, args = parse_options(sys.argv[1:])
+	if len(args) != 5:
+		print("Usage: [options] <config> <format> <abbreviations> <input> <output>")
+		print("Options:")
+		print("	--mention_cache <file>	Load mention lookup results from this file and save them at the end")
+		print("	--abbr_prefilter	Only load abbreviations for the documents in the input")
+		print("	--abbr_from_input	Also take the abbreviations from the ABBR relations of each BioC input document")
+		print("	--abbr_workers <n>	Load the abbreviation files with this many processes")
+		print("	--streaming	Read, normalize and write BioC XML input one document at a time")
+		print("	--tsv_mode <mode>	Group TSV input into documents in memory (default), as sorted runs or by spilling to temporary files")
+		print("	--split <n>	Split a single PubTator or TSV input file into n ranges and process them in parallel")
+		print("	--workers <n>	Process the files of an input directory with n processes")
+		print("Use - as <abbreviations> to load no abbreviation files")
 		exit()
-	config_filename = sys.argv[1]
-	input_format = sys.argv[2].lower()
-	abbr_path = sys.argv[3]
-	input_path = sys.argv[4]
-	output_path = sys.argv[5]
+	config_filename = args[0]
+	input_format = args[1].lower()
+	if "--abbr_from_input" in options and input_format != "biocxml":
+		raise ValueError("Option --abbr_from_input requires BioC XML input")
+	if "--streaming" in options and input_format != "biocxml":
+		raise ValueError("Option --streaming requires BioC XML input")
+	if "--tsv_mode" in options and input_format != "tsv":
+		raise ValueError("Option --tsv_mode requires TSV input")
+	split = int(options.get("--split", 1))
+	if split > 1 and input_format == "biocxml":
+		raise ValueError("Option --split requires PubTator or TSV input")
+	workers = int(options.get("--workers", 1))
+	abbr_path = args[2]
+	input_path = args[3]
+	output_path = args[4]
+	if split > 1 and os.path.isdir(input_path):
+		raise ValueError("Option --split requires a single input file")
+	if workers > 1 and not os.path.isdir(input_path):
+		raise ValueError("Option --workers requires an input directory")
 
 	# Load the configuration
 	print("Loading configuration")
@@ -54,6 +196,11 @@ if __name__ == "__main__":
 	# Create the DictionaryNormalizer
 	filter = target2filter[config["target_resource"]]
 	normalizer = DictionaryNormalizer(config, filter)
+	mention_cache_filename = options.get("--mention_cache")
+	if not mention_cache_filename is None:
+		# Cached results are only valid for the dictionary that produced them
+		fingerprint = dictionary_fingerprint(config)
+		normalizer.load_mention_cache(mention_cache_filename, fingerprint)
 	
 	# Create the DocumentProcessor
 	type2normalizer = dict()
@@ -62,14 +209,33 @@ if __name__ == "__main__":
 		doc_processor = PubTatorDocumentProcessor(type2normalizer, abbr)
 	elif input_format == "biocxml":
 		doc_processor = DocumentProcessor(type2normalizer, abbr)
+		doc_processor.abbr_from_input = "--abbr_from_input" in options
+		doc_processor.streaming = "--streaming" in options
 	elif input_format == "tsv":
 		doc_processor = TSVDocumentProcessor(type2normalizer, abbr)
+		doc_processor.mode = options.get("--tsv_mode", "memory")
+		if not doc_processor.mode in tsv_modes:
+			raise ValueError("Unknown TSV mode: " + doc_processor.mode)
 	else:
 		raise ValueError("Unknown format: {}".format(input_format))
 	
 	# Load the abbreviations
-	print("Loading abbreviations")
-	abbr.load(abbr_path)
+	if "--abbr_prefilter" in options:
+		print("Scanning input for document IDs")
+		if os.path.isdir(input_path):
+			input_filenames = [input_path + "/" + item for item in os.listdir(input_path) if os.path.isfile(input_path + "/" + item)]
+		else:
+			input_filenames = [input_path]
+		document_ids = set()
+		for input_filename in input_filenames:
+			document_ids.update(doc_processor.get_document_ids(input_filename))
+		print("Found " + str(len(document_ids)) + " documents")
+		abbr.document_filter = document_ids
+	if abbr_path == "-":
+		print("Skipping abbreviation files")
+	else:
+		print("Loading abbreviations")
+		abbr.load(abbr_path, int(options.get("--abbr_workers", 1)))
 	
 	print("Total init time = " + str(datetime.datetime.now() - start))
 
@@ -81,23 +247,34 @@ if __name__ == "__main__":
 		print("Processing directory " + input_path)
 		# Process any xml files found
 		dir = os.listdir(input_path)
-		for item in dir:
-			input_filename = input_path + "/" + item
-			output_filename = output_path + "/" + item
-			if os.path.isfile(input_filename):
-				print("Processing file " + input_filename + " to " + output_filename)
-				doc_processor.process_file(input_filename, output_filename)
+		if workers > 1:
+			tasks = [(input_path + "/" + item, None, output_path + "/" + item) for item in dir if os.path.isfile(input_path + "/" + item)]
+			process_directory(doc_processor, tasks, workers)
+		else:
+			for item in dir:
+				input_filename = input_path + "/" + item
+				output_filename = output_path + "/" + item
+				if os.path.isfile(input_filename):
+					print("Processing file " + input_filename + " to " + output_filename)
+					doc_processor.process_file(input_filename, output_filename)
 	elif os.path.isfile(input_path):
 		# TODO If output_path exists, it must be a file
 		# TODO If output_path does not exist, then its location must be a directory that exists
 		if os.path.isdir(output_path):
 			raise RuntimeError("If input path is a file then output path may not be a directory: " + output_path)
 		print("Processing file " + input_path + " to " + output_path)
-		# Process directly
-		doc_processor.process_file(input_path, output_path)
+		if split > 1:
+			process_split(doc_processor, input_path, output_path, split)
+		else:
+			# Process directly
+			doc_processor.process_file(input_path, output_path)
 	else:  
 		raise RuntimeError("Path is not a directory or normal file: " + input_path)
 	print("Total processing time = " + str(datetime.datetime.now() - start))
+	normalizer.mention_cache.report()
+	strings.report_missing_unicode()
+	if not mention_cache_filename is None:
+		normalizer.save_mention_cache(mention_cache_filename, fingerprint)
 
 	print("Done.")
 	
@@ -1,24 +1,23 @@
+import collections
 import re
 import sys
 import unidecode
 
+# Separates a lowercase character followed by an uppercase character
+case_change_pattern = re.compile("([a-z])([A-Z])")
+# Looks for 4 classes
+# Class 1: Sequences of "word" characters other than digits or underscores (ie letters)
+# Class 2: Sequences of digits
+# Class 3: Single characters that are not "word" characters or whitespace
+# Class 4: Single underscores
+# Note: "word" characters are alphabetic, digits and underscore
+token_pattern = re.compile("[^\\W\\d_]+|\\d+|[^\\w\\s]|_", re.UNICODE)
+
 def tokenize(string):
-	# Separate a lowercase character followed by an uppercase character
-	string2 = re.sub("([a-z])([A-Z])", "\\1 \\2", string)
-	# Translation: looks for 4 classes
-	# Class 1: Sequences of "word" characters other than digits or underscores (ie letters)
-	# Class 2: Sequences of digits
-	# Class 3: Single characters that are not "word" characters or whitespace
-	# Class 4: Single underscores
-	# Note: "word" characters are alphabetic, digits and underscore
-	return re.findall("[^\W\d_]+|\d+|[^\w\s]|_", string2, re.UNICODE)
+	return token_pattern.findall(case_change_pattern.sub("\\1 \\2", string))
 
 def spacify(string):
-	tokens = tokenize(string)
-	string2 = ""
-	for token in tokens:
-		string2 = string2 + " " + token
-	return string2.strip()
+	return " ".join(tokenize(string))
 
 custom_ASCII_map = {
 	# Suppressed (not useful for name matching)
@@ -88,92 +87,120 @@ custom_ASCII_expansion = {
 	u"\u03C9": u"omega"
 }
 
-def map_to_ASCII(text):
-	# Apply custom mappings
-	new_text = __custom_map_to_ASCII__(text)
-	# Map remainder
-	new_text = unidecode.unidecode(new_text)
-	# Verify result is ASCII
-	new_text = __restrict_to_ASCII__(new_text)
-	new_text = re.sub("\s+", " ", new_text.strip())
-	return new_text
+# Matches the characters in custom_ASCII_expansion
+expansion_pattern = re.compile("[" + "".join(custom_ASCII_expansion) + "]")
 
-def __custom_map_to_ASCII__(text):
-	# Apply custom mappings
-	new_text = ""
-	for i in range(len(text)):
-		c = text[i]
+ASCII_letters = set("ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz")
+
+class ASCIITable(dict):
+	# Translation table from each non-ASCII codepoint to its ASCII replacement, filled in as codepoints are first seen
+
+	def __init__(self):
+		super().__init__()
+		# Codepoints without an ASCII replacement
+		self.missing = set()
+
+	def __missing__(self, code):
+		c = chr(code)
 		if c in custom_ASCII_map:
-			new_text += custom_ASCII_map[c]
-		elif c in custom_ASCII_expansion:
-			# Add spaces if needed
-			if i > 0 and re.fullmatch("[A-Za-z]", text[i-1]):
-				new_text += " "
-			new_text += custom_ASCII_expansion[c]
-			if i+1 < len(text) and re.fullmatch("[A-Za-z]", text[i+1]):
-				new_text += " "
+			replacement = custom_ASCII_map[c]
 		else:
-			new_text += c
+			decoded = unidecode.unidecode(c)
+			replacement = __restrict_to_ASCII__(decoded)
+			if replacement != decoded:
+				self.missing.add(c)
+		self[code] = replacement
+		return replacement
+
+ASCII_table = ASCIITable()
+
+# Number of occurrences of each character without an ASCII replacement, see report_missing_unicode()
+missing_unicode = collections.Counter()
+
+def map_to_ASCII(text):
+	if text.isascii():
+		return " ".join(text.split())
+	# Apply custom expansions, which depend on the neighbouring characters
+	new_text = expansion_pattern.sub(__expand__, text)
+	# Map remainder, one codepoint at a time
+	new_text = new_text.translate(ASCII_table)
+	if len(ASCII_table.missing) > 0:
+		for c in ASCII_table.missing:
+			count = text.count(c)
+			if count > 0:
+				missing_unicode[c] += count
+	return " ".join(new_text.split())
+
+def __expand__(match):
+	# Add spaces if needed
+	text = match.string
+	i = match.start()
+	new_text = custom_ASCII_expansion[match.group()]
+	if i > 0 and text[i-1] in ASCII_letters:
+		new_text = " " + new_text
+	if i+1 < len(text) and text[i+1] in ASCII_letters:
+		new_text = new_text + " "
 	return new_text
 
 def __restrict_to_ASCII__(text):
+	# Verify result is ASCII
 	new_text = ""
 	for c in text:
 		if ord(c) < 128:
 			new_text += c
 		else:
-			#print("WARN MISSING Unicode:", hex(ord(c)), c, file=sys.stderr)
-			sys.stderr.write("WARN MISSING Unicode: " + hex(ord(c)) + " " + c + "\n")
-			#print("ZZZ")
 			new_text += " "
 	return new_text
 
+def report_missing_unicode():
+	# Writes one warning per character that could not be mapped to ASCII, with the number of times it was seen
+	for c, count in sorted(missing_unicode.items()):
+		sys.stderr.write("WARN MISSING Unicode: " + hex(ord(c)) + " " + c + " (" + str(count) + " times)\n")
+
 def locate(string, tokens):
 	# Get locations list for tokens
 	start = 0
 	locations = list()
 	for token in tokens:
-		#print("start is " + str(start))
 		index = string.find(token, start)
-		#print("index is " + str(index))
 		locations.append(index)
 		start = index + len(token)
 	return locations
 
 # Tokenizes the string, applies the given function to each token and returns the reassembled string
 def apply_tokenwise(string, func):
-	tokens = tokenize(string)
-	#print("tokens = " + str(tokens))
-	locations = locate(string, tokens)
-	#print("locations = " + str(locations))
-	
-	# Process each token and replace original if changed
-	template = string
-	tokens.reverse()
-	locations.reverse()
-	for index in range(0,len(tokens)):
-		token = tokens[index]
-		#print("token = " + token)
+	return __reassemble__(string, tokenize(string), func)
+
+def __reassemble__(string, tokens, func):
+	# The text between the tokens is only whitespace, so each token is found after the previous one in a single pass
+	parts = list()
+	start = 0
+	end = 0
+	for token in tokens:
+		location = string.find(token, end)
+		end = location + len(token)
 		processed = func(token)
-		#print("processed = " + processed)
 		if token != processed:
-			location = locations[index]
-			#print("location = " + str(location))
-			template = template[:location] + processed + template[location + len(token):]
-			#print("before = " + template[:location])
-			#print("processed = " + processed)
-			#print("after = " + template[location + len(processed):])
-	return template
+			parts.append(string[start:location])
+			parts.append(processed)
+			start = end
+	if len(parts) == 0:
+		return string
+	parts.append(string[start:])
+	return "".join(parts)
+
+allcaps_pattern = re.compile("^[A-Z]+$")
+firstcaps_pattern = re.compile("^[A-Z][a-z]*$")
 
 def allcaps_lower(string):
 	# TODO Make UNICODE friendly
-	if re.match("^[A-Z]+$", string):
+	if allcaps_pattern.match(string):
 		return string.lower()
 	return string
 
 def firstcaps_lower(string):
 	# TODO Make UNICODE friendly
-	if re.match("^[A-Z][a-z]*$", string):
+	if firstcaps_pattern.match(string):
 		return string.lower()
 	return string
 
@@ -0,0 +1,138 @@
+import os
+import tempfile
+import unittest
+
+from bioc import biocxml
+
+import abbreviations
+from abbreviations import AbbreviationExpander
+
+class TestAbbreviations(unittest.TestCase):
+
+	# Abbreviations in BioC XML
+	xml = """<?xml version='1.0' encoding='utf-8'?>
+<collection><source>s</source><date>d</date><key>k</key>
+<document><id>1</id>
+<passage><offset>0</offset>
+<annotation id="A1"><infon key="type">ABBR</infon><location offset="0" length="3"/><text>CAs</text></annotation>
+<annotation id="A2"><infon key="type">ABBR</infon><location offset="5" length="12"/><text>citric acids</text></annotation>
+<annotation id="A3"><infon key="type">Chemical</infon><location offset="5" length="12"/><text>citric acids</text></annotation>
+<relation id="R1"><infon key="type">ABBR</infon><node refid="A2" role="LongForm"/><node refid="A1" role="ShortForm"/></relation>
+<relation id="R2"><infon key="type">ABBR</infon><node refid="A3" role="LongForm"/><node refid="A1" role="ShortForm"/></relation>
+</passage>
+</document>
+<document><id>2</id>
+<passage><offset>0</offset>
+<annotation id="A1"><infon key="type">ABBR</infon><location offset="0" length="1"/><text>T</text></annotation>
+<annotation id="A2"><infon key="type">ABBR</infon><location offset="2" length="3"/><text>tea</text></annotation>
+<relation id="R1"><infon key="type">ABBR</infon><node refid="A1" role="ShortForm"/><node refid="A2" role="LongForm"/></relation>
+</passage>
+</document>
+</collection>
+"""
+
+	def setUp(self):
+		self.abbr = AbbreviationExpander()
+		self.abbr.add("1", "NaCl", "sodium chloride")
+		self.abbr.add("1", "CA", "citric acid")
+		self.abbr.add("1", "CAT", "catalase")
+		self.abbr.add("1", "TCA", "tri CA")
+		self.abbr.add("2", "CA", "calcium")
+
+	def test_expand(self):
+		self.assertEqual("sodium chloride", self.abbr.expand("1", "NaCl"))
+		self.assertEqual("sodium chloride ", self.abbr.expand("1", "sodium chloride (NaCl)"))
+		self.assertEqual("citric acid and catalase", self.abbr.expand("1", "CA and CAT"))
+		self.assertEqual("CAs", self.abbr.expand("1", "CAs"))
+		self.assertEqual("calcium", self.abbr.expand("2", "CA"))
+		self.assertEqual("CA", self.abbr.expand("3", "CA"))
+		# Expansions are applied until nothing changes, each abbreviation at most once
+		self.assertEqual("tri citric acid", self.abbr.expand("1", "TCA"))
+		self.assertEqual("tri CA citric acid", self.abbr.expand("1", "TCA CA"))
+
+	def test_matcher(self):
+		matcher = self.abbr.get_matcher("1")
+		self.assertEqual({1, 2, 3}, matcher.find("xTCAT"))
+		self.assertEqual(set(), matcher.find("glucose"))
+		# Adding an abbreviation replaces the matcher for that document only
+		matcher2 = self.abbr.get_matcher("2")
+		self.abbr.add("1", "Glc", "glucose")
+		self.assertEqual("glucose", self.abbr.expand("1", "Glc"))
+		self.assertIsNot(matcher, self.abbr.get_matcher("1"))
+		self.assertIs(matcher2, self.abbr.get_matcher("2"))
+
+	def test_index(self):
+		with tempfile.TemporaryDirectory() as directory:
+			tsv_filename = os.path.join(directory, "abbreviations.tsv")
+			with open(tsv_filename, "w") as file:
+				file.write("1\tCA\tcitric acid\n1\tCA\tcalcium\n1\tTCAs\ttri CAs\n2\tCA\tcalcium\nmalformed\n3\tNaCl\tsodium chloride\n")
+			index_filename = os.path.join(directory, "abbreviations.db")
+			abbreviations.write_index(tsv_filename, index_filename)
+			abbr = AbbreviationExpander()
+			abbr.load(tsv_filename)
+			indexed_abbr = AbbreviationExpander()
+			indexed_abbr.load(index_filename)
+			indexed_abbr.document_cache_size = 1
+			self.assertEqual(0, len(indexed_abbr.abbr_dict))
+			for document_ID in ["1", "2", "1", "3", "4", "1"]:
+				for text in ["CA", "TCA", "TCAs", "NaCl"]:
+					self.assertEqual(abbr.expand(document_ID, text), indexed_abbr.expand(document_ID, text))
+				self.assertEqual(abbr.abbr_dict.get(document_ID, dict()), indexed_abbr.abbr_dict[document_ID])
+			self.assertEqual(["1"], list(indexed_abbr.abbr_dict))
+
+	def test_document_filter(self):
+		with tempfile.TemporaryDirectory() as directory:
+			tsv_filename = os.path.join(directory, "abbreviations.tsv")
+			with open(tsv_filename, "w") as file:
+				file.write("1\tCA\tcitric acid\n2\tCA\tcalcium\n3\tNaCl\tsodium chloride\n")
+			abbr = AbbreviationExpander()
+			abbr.document_filter = {"2", "4"}
+			abbr.load(tsv_filename)
+			self.assertEqual(["2"], list(abbr.abbr_dict))
+			self.assertEqual("calcium", abbr.expand("2", "CA"))
+
+	def test_parallel_load(self):
+		abbr_freq_dict = {"CA": {"citric acid": 2, "calcium": 5, "carbonic anhydrase": 5}}
+		with tempfile.TemporaryDirectory() as directory:
+			shards = ["1\tCA\tcitric acid\n2\tCA\tcitric acid\n", "1\tCA\tcarbonic anhydrase\n2\tNaCl\tsodium chloride\n3\tCA\tCA acid\n", "1\tCA\tcalcium\n2\tCAs\tcalciums\n"]
+			for index, shard in enumerate(shards):
+				with open(os.path.join(directory, "shard" + str(index) + ".tsv"), "w") as file:
+					file.write(shard)
+			abbr = AbbreviationExpander(abbr_freq_dict)
+			abbr.load(directory)
+			parallel_abbr = AbbreviationExpander(abbr_freq_dict)
+			parallel_abbr.load(directory, 3)
+			self.assertEqual(list(abbr.abbr_dict.items()), list(parallel_abbr.abbr_dict.items()))
+			for document_ID, doc_dict in abbr.abbr_dict.items():
+				self.assertEqual(list(doc_dict.items()), list(parallel_abbr.abbr_dict[document_ID].items()))
+			self.assertEqual("carbonic anhydrase", parallel_abbr.abbr_dict["1"]["CA"])
+
+	def test_read_biocxml(self):
+		with tempfile.TemporaryDirectory() as directory:
+			xml_filename = os.path.join(directory, "abbreviations.xml")
+			with open(xml_filename, "w") as file:
+				file.write(self.xml)
+			self.assertEqual([("1", "CAs", "citric acids"), ("2", "T", "tea")], list(abbreviations.read_biocxml(xml_filename)))
+			abbr = AbbreviationExpander()
+			abbr.load(xml_filename)
+			self.assertEqual({"1": {"CAs": "citric acids", "CA": "citric acid"}, "2": {"T": "tea"}}, abbr.abbr_dict)
+
+	def test_relation_without_id(self):
+		# A relation without its forms is skipped with a warning, also when it has no id
+		xml = self.xml.replace('<relation id="R1"><infon key="type">ABBR</infon><node refid="A1" role="ShortForm"/>', '<relation><infon key="type">ABBR</infon><node refid="A9" role="ShortForm"/>')
+		with tempfile.TemporaryDirectory() as directory:
+			xml_filename = os.path.join(directory, "abbreviations.xml")
+			with open(xml_filename, "w") as file:
+				file.write(xml)
+			self.assertEqual([("1", "CAs", "citric acids")], list(abbreviations.read_biocxml(xml_filename)))
+
+	def test_read_document(self):
+		# Same abbreviations from documents that are already loaded
+		collection = biocxml.loads(self.xml)
+		self.assertEqual([("1", "CAs", "citric acids"), ("2", "T", "tea")], [row for document in collection.documents for row in abbreviations.read_document(document)])
+		self.abbr.remove_document("1")
+		self.assertEqual("CA", self.abbr.expand("1", "CA"))
+		self.assertEqual("calcium", self.abbr.expand("2", "CA"))
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,305 @@
+import contextlib
+import io
+import json
+import os
+import tempfile
+import unittest
+
+import dictionary_snapshot
+import dictionary_normalizer2
+from dictionary_normalizer import DictionaryNormalizer, dictionary_fingerprint, get_templates, s_stem
+from dictionary_normalizer2 import DictionaryNormalizer2
+
+def target_MESH(resource, accession):
+	return resource == "MESH" and not accession.startswith("Q")
+
+name2ids = {
+	"Sodium chloride": ["MESH:D012965", "CHEBI:26710"],
+	"NaCl": ["MESH:D012965"],
+	"salt": ["MESH:D012965", "CHEBI:24866"],
+	"Glucose": ["MESH:D005947"],
+	"glucoses": ["MESH:D005947"],
+	"alpha-D-glucose": ["CHEBI:17925"],
+	"Vitamin D 3": ["MESH:D002762"],
+	"Qualifier": ["MESH:Q000032"],
+	# Only in plural form, so its c_template and p_template differ
+	"Citric acids": ["MESH:D019343"],
+}
+
+id2ids = {
+	"CHEBI:17925": ["MESH:D005947", "CHEBI:17925"],
+	"CHEBI:26710": ["MESH:D012965"],
+}
+
+allowed_ids = ["MESH:D012965", "MESH:D005947", "MESH:D002762", "MESH:D019343"]
+
+mentions = ["NaCl", "Salts", "sodium chloride", "Sodium-Chloride", "glucose", "Glucoses", "alpha D glucose", "vitamin D3", "Qualifier", "citric acid", "unknown"]
+
+def write_dictionary(directory):
+	# Writes the test dictionary files into the directory and returns a configuration that uses them
+	def write(filename, text):
+		filename = os.path.join(directory, filename)
+		with open(filename, "w") as file:
+			file.write(text)
+		return filename
+	config = dict()
+	config["unknown_id"] = "-"
+	config["target_resource"] = "MESH"
+	config["id2type_filename"] = write("chem_ids.tsv", "".join(id + "\t" + str(id in allowed_ids) + "\n" for id in sorted({id for ids in name2ids.values() for id in ids})))
+	config["name2ids_filename"] = write("name2ids.txt", json.dumps(name2ids))
+	config["id2ids_filename"] = write("id2ids.txt", json.dumps(id2ids))
+	config["c_template_cache_filename"] = os.path.join(directory, "c_template_cache.txt")
+	config["p_template_cache_filename"] = os.path.join(directory, "p_template_cache.txt")
+	return config
+
+class TestDictionaryNormalizer(unittest.TestCase):
+
+	def setUp(self):
+		self.directory = tempfile.TemporaryDirectory()
+		self.config = write_dictionary(self.directory.name)
+
+	def tearDown(self):
+		self.directory.cleanup()
+
+	def write(self, filename, text):
+		filename = os.path.join(self.directory.name, filename)
+		with open(filename, "w") as file:
+			file.write(text)
+		return filename
+
+	def test_template_lookup(self):
+		# DictionaryNormalizer2 still resolves templates through the names
+		normalizer = DictionaryNormalizer(self.config, target_MESH)
+		normalizer2 = DictionaryNormalizer2(self.config, target_MESH)
+		for template, names in normalizer2.c_template2names.items():
+			self.assertEqual(normalizer2.c_template_lookup(template), normalizer.c_template_lookup(template))
+		for template, names in normalizer2.p_template2names.items():
+			self.assertEqual(normalizer2.p_template_lookup(template), normalizer.p_template_lookup(template))
+		self.assertEqual(set(), normalizer.c_template_lookup("unknown"))
+		for mention in mentions:
+			self.assertEqual(normalizer2.normalize_mention(mention)[0], normalizer.normalize_mention(mention))
+
+	def test_get_templates(self):
+		self.assertEqual(("sodiumchloride", "sodiumchloride"), get_templates("Sodium-Chloride"))
+		self.assertEqual(("alphad glucoses", "alphad glucose"), get_templates("alpha-D-glucoses"))
+		self.assertEqual(("1 25dihydroxyvitamind3", "1 25dihydroxyvitamind3"), get_templates("1,25-dihydroxyvitamin D3"))
+		self.assertEqual(("1 2", "1 2"), get_templates("1-2"))
+		self.assertEqual(("ab cd", "ab cd"), get_templates("a b c d"))
+		self.assertEqual(("bs c", "b  c"), get_templates("b s c"))
+		# Same templates as the original regular expressions
+		for name in mentions + list(name2ids) + ["", "-", "s", "a s", "x ies y", "a b1 c 2 d e f", "ss us eies aes", "A B 12 C D", "NF-\u03BAB", "Gö6976 s-s"]:
+			self.assertEqual(dictionary_normalizer2.get_templates(name), get_templates(name))
+		for word in ["s", "ss", "us", "ies", "eies", "aies", "es", "aes", "ees", "oes", "glucoses", "acid"]:
+			self.assertEqual(dictionary_normalizer2.s_stem(word), s_stem(word))
+
+	def test_trace_lookups(self):
+		normalizer = DictionaryNormalizer(self.config, target_MESH)
+		config = dict(self.config)
+		config["trace_lookups"] = True
+		trace_normalizer = DictionaryNormalizer(config, target_MESH)
+		for mention in mentions + list(name2ids):
+			self.assertEqual(trace_normalizer.lookup_mention(mention), normalizer.lookup_mention(mention))
+		# The LOOKUP lines log ID strings, whether or not the IDs are interned
+		interned_normalizer = DictionaryNormalizer(dict(config, intern_ids = True), target_MESH)
+		for mention in mentions + list(name2ids):
+			traces = list()
+			for normalizer2 in (trace_normalizer, interned_normalizer):
+				output = io.StringIO()
+				with contextlib.redirect_stdout(output):
+					normalizer2.lookup_mention(mention)
+				traces.append(output.getvalue())
+			self.assertEqual(traces[0], traces[1])
+		# The last mention is the dictionary name Citric acids
+		self.assertIn("\t{'MESH:D019343'}\t0\n", traces[1])
+		self.assertEqual(({"MESH:D012965"}, 0), normalizer.lookup_mention("NaCl"))
+		self.assertEqual(({"MESH:D005947"}, 1), normalizer.lookup_mention("glucose"))
+		self.assertEqual(({"MESH:D005947"}, 3), normalizer.lookup_mention("alpha D glucose"))
+		self.assertEqual(({"MESH:D012965"}, 2), normalizer.lookup_mention("Salts"))
+		self.assertEqual((set(), 4), normalizer.lookup_mention("unknown"))
+
+	def test_normalize_mentions(self):
+		config = dict(self.config)
+		config["flat_table_filename"] = os.path.join(self.directory.name, "flat_table.txt")
+		batch = mentions + list(name2ids) + ["NaCl", "sodium-chloride", "alpha-d glucoses"]
+		for normalizer in (DictionaryNormalizer(self.config, target_MESH), DictionaryNormalizer(config, target_MESH), DictionaryNormalizer(dict(config, trace_lookups = True), target_MESH)):
+			normalizer2 = DictionaryNormalizer(self.config, target_MESH)
+			self.assertEqual([normalizer2.lookup_mention(mention) for mention in batch], normalizer.lookup_mentions(batch))
+			self.assertEqual([normalizer2.normalize_mention(mention) for mention in batch], normalizer.normalize_mentions(batch))
+		self.assertEqual([], normalizer.normalize_mentions([]))
+		normalizer = DictionaryNormalizer(self.config, target_MESH)
+		normalizer.normalize_mentions(["NaCl", "glucose", "NaCl"])
+		self.assertEqual((0, 2), (normalizer.mention_cache.hits, normalizer.mention_cache.misses))
+		normalizer.normalize_mentions(["glucose", "unknown"])
+		self.assertEqual((1, 3), (normalizer.mention_cache.hits, normalizer.mention_cache.misses))
+		# Found through the p_template of a name that is only in plural form
+		self.assertEqual(({"MESH:D019343"}, 2), normalizer.lookup_mention("citric acid"))
+
+	def test_mention_cache(self):
+		config = dict(self.config)
+		config["mention_cache_size"] = 2
+		normalizer = DictionaryNormalizer(config, target_MESH)
+		self.assertEqual({"MESH:D012965"}, normalizer.normalize_mention("NaCl"))
+		self.assertEqual({"MESH:D005947"}, normalizer.normalize_mention("glucose"))
+		self.assertEqual({"MESH:D012965"}, normalizer.normalize_mention("NaCl"))
+		self.assertEqual(set(), normalizer.normalize_mention("unknown"))
+		self.assertEqual({"MESH:D005947"}, normalizer.normalize_mention("glucose"))
+		self.assertEqual((1, 4, 2), (normalizer.mention_cache.hits, normalizer.mention_cache.misses, normalizer.mention_cache.evictions))
+		self.assertEqual(["unknown", "glucose"], list(normalizer.mention_cache.entries))
+
+	def test_persistent_mention_cache(self):
+		config = dict(self.config)
+		config["intern_ids"] = True
+		normalizer = DictionaryNormalizer(config, target_MESH)
+		fingerprint = dictionary_fingerprint(config)
+		cache_filename = os.path.join(self.directory.name, "mention_cache.json.gz")
+		for mention in mentions:
+			normalizer.normalize_mention(mention)
+		normalizer.save_mention_cache(cache_filename, fingerprint)
+
+		normalizer2 = DictionaryNormalizer(config, target_MESH)
+		normalizer2.load_mention_cache(cache_filename, fingerprint)
+		self.assertEqual(list(normalizer.mention_cache.entries.items()), list(normalizer2.mention_cache.entries.items()))
+		for mention in mentions:
+			normalizer2.normalize_mention(mention)
+		self.assertEqual(0, normalizer2.mention_cache.misses)
+
+		# Changing the dictionary invalidates the cache
+		self.write("name2ids.txt", json.dumps({"NaCl": ["MESH:D005947"]}))
+		self.assertNotEqual(fingerprint, dictionary_fingerprint(config))
+		normalizer3 = DictionaryNormalizer(config, target_MESH)
+		normalizer3.load_mention_cache(cache_filename, dictionary_fingerprint(config))
+		self.assertEqual(0, len(normalizer3.mention_cache))
+		# Cached IDs are strings, so interned and string modes share the fingerprint
+		self.assertEqual(dictionary_fingerprint(config), dictionary_fingerprint(dict(config, intern_ids = False)))
+
+		# A snapshot is hashed in place of the files it was compiled from
+		config["snapshot_filename"] = os.path.join(self.directory.name, "dictionary.snapshot")
+		normalizer4 = DictionaryNormalizer(self.config, target_MESH)
+		normalizer4.flatten()
+		dictionary_snapshot.write(normalizer4, config["snapshot_filename"], "MESH")
+		fingerprint = dictionary_fingerprint(config)
+		self.write("name2ids.txt", json.dumps(name2ids))
+		self.assertEqual(fingerprint, dictionary_fingerprint(config))
+		# Recompiling the snapshot invalidates the cache
+		normalizer4 = DictionaryNormalizer(self.config, target_MESH)
+		normalizer4.flatten()
+		dictionary_snapshot.write(normalizer4, config["snapshot_filename"], "MESH")
+		self.assertNotEqual(fingerprint, dictionary_fingerprint(config))
+
+		# Files the dictionary is loaded from must exist
+		del config["snapshot_filename"]
+		os.remove(config["id2ids_filename"])
+		with self.assertRaises(RuntimeError):
+			dictionary_fingerprint(config)
+
+	def test_shared_postings(self):
+		normalizer = DictionaryNormalizer(self.config, target_MESH)
+		self.assertIs(normalizer.name2ids["Glucose"], normalizer.name2ids["glucoses"])
+		self.assertIs(normalizer.c_template2ids["glucose"], normalizer.p_template2ids["glucose"])
+		config = dict(self.config)
+		config["intern_ids"] = True
+		normalizer = DictionaryNormalizer(config, target_MESH)
+		self.assertIs(normalizer.name2ids["Glucose"], normalizer.name2ids["glucoses"])
+		self.assertIs(normalizer.c_template2ids["glucose"], normalizer.name2ids["Glucose"])
+		normalizer2 = DictionaryNormalizer2(self.config, target_MESH)
+		self.assertIs(normalizer2.name2ids["Glucose"], normalizer2.name2ids["glucoses"])
+
+	def test_flat_tables(self):
+		normalizer = DictionaryNormalizer(self.config, target_MESH)
+		config = dict(self.config)
+		config["flat_table_filename"] = os.path.join(self.directory.name, "flat_table.txt")
+		flat_normalizer = DictionaryNormalizer(config, target_MESH)
+		self.assertTrue(os.path.exists(config["flat_table_filename"]))
+		self.assertEqual(len(name2ids), len(flat_normalizer.flat_names))
+		self.assertEqual(({"MESH:D005947"}, 3), flat_normalizer.flat_names["alpha-D-glucose"])
+		for mention in mentions + list(name2ids):
+			self.assertEqual(normalizer.lookup_mention(mention), flat_normalizer.lookup_mention(mention))
+		# Loaded from the cache
+		config["intern_ids"] = True
+		interned_normalizer = DictionaryNormalizer(config, target_MESH)
+		self.assertEqual(len(flat_normalizer.flat_templates), len(interned_normalizer.flat_templates))
+		for mention in mentions + list(name2ids):
+			entities, sieve = interned_normalizer.lookup_mention(mention)
+			self.assertEqual(normalizer.lookup_mention(mention), (set(interned_normalizer.to_identifiers(entities)), sieve))
+		# Tables written by another version are rejected
+		with open(config["flat_table_filename"], "w") as file:
+			json.dump({"names": dict(), "templates": dict()}, file)
+		with self.assertRaises(ValueError):
+			DictionaryNormalizer(config, target_MESH)
+
+	def test_snapshot(self):
+		normalizer = DictionaryNormalizer(self.config, target_MESH)
+		config = dict(self.config)
+		config["snapshot_filename"] = os.path.join(self.directory.name, "dictionary.snapshot")
+		normalizer.flatten()
+		dictionary_snapshot.write(normalizer, config["snapshot_filename"], "MESH")
+		snapshot_normalizer = DictionaryNormalizer(config, target_MESH)
+
+		self.assertEqual(set(normalizer.name2ids), set(snapshot_normalizer.name2ids))
+		self.assertEqual(normalizer.entity_names, dict(snapshot_normalizer.entity_names.items()))
+		self.assertEqual(normalizer.entity_flags, dict(snapshot_normalizer.entity_flags.items()))
+		self.assertFalse("MESH:D999999" in snapshot_normalizer.id2ids)
+		self.assertEqual(normalizer.flat_names, dict(snapshot_normalizer.flat_names.items()))
+		self.assertEqual(normalizer.flat_templates, dict(snapshot_normalizer.flat_templates.items()))
+		for mention in mentions:
+			self.assertEqual(normalizer.normalize_mention(mention), snapshot_normalizer.normalize_mention(mention))
+
+	def test_intern_ids(self):
+		normalizer = DictionaryNormalizer(self.config, target_MESH)
+		snapshot_filename = os.path.join(self.directory.name, "dictionary.snapshot")
+		normalizer.flatten()
+		dictionary_snapshot.write(normalizer, snapshot_filename, "MESH")
+		config = dict(self.config)
+		config["intern_ids"] = True
+		interned_normalizer = DictionaryNormalizer(config, target_MESH)
+		config["snapshot_filename"] = snapshot_filename
+		snapshot_normalizer = DictionaryNormalizer(config, target_MESH)
+		self.assertEqual(["-"], interned_normalizer.to_identifiers({interned_normalizer.unknown_entity}))
+		self.assertEqual(["-"], snapshot_normalizer.to_identifiers({snapshot_normalizer.unknown_entity}))
+		for mention in mentions:
+			expected = normalizer.to_identifiers(normalizer.normalize_mention(mention))
+			entities = interned_normalizer.normalize_mention(mention)
+			self.assertTrue(all(isinstance(entity, int) for entity in entities))
+			self.assertEqual(expected, interned_normalizer.to_identifiers(entities))
+			self.assertEqual(expected, snapshot_normalizer.to_identifiers(snapshot_normalizer.normalize_mention(mention)))
+		for id in allowed_ids:
+			self.assertTrue(interned_normalizer.is_allowed(interned_normalizer.entity_ids.find(id)))
+			self.assertTrue(snapshot_normalizer.is_allowed(snapshot_normalizer.entity_ids.find(id)))
+
+	def test_entity_metadata(self):
+		normalizer = DictionaryNormalizer(self.config, target_MESH)
+		self.assertTrue(normalizer.is_allowed("-"))
+		self.assertTrue(normalizer.is_allowed("MESH:D012965"))
+		self.assertFalse(normalizer.is_allowed("CHEBI:26710"))
+		self.assertEqual({"MESH:D012965", "MESH:D005947"}, normalizer.filter_nontarget({"MESH:D012965", "MESH:D005947", "MESH:Q000032", "CHEBI:17925"}))
+		self.assertEqual("glucose", normalizer.entity_name("MESH:D005947"))
+		self.assertEqual(None, normalizer.entity_name("-"))
+		config = dict(self.config)
+		config["snapshot_filename"] = os.path.join(self.directory.name, "dictionary.snapshot")
+		normalizer.flatten()
+		dictionary_snapshot.write(normalizer, config["snapshot_filename"], "MESH")
+		config["intern_ids"] = True
+		for normalizer2 in (DictionaryNormalizer(config, target_MESH), DictionaryNormalizer(dict(self.config, intern_ids = True), target_MESH)):
+			for identifier in ("-", "MESH:D012965", "MESH:D005947", "MESH:Q000032", "CHEBI:26710"):
+				entity = normalizer2.entity_ids.find(identifier)
+				self.assertEqual(normalizer.is_allowed(identifier), normalizer2.is_allowed(entity))
+				self.assertEqual(normalizer.entity_name(identifier), normalizer2.entity_name(entity))
+				self.assertEqual(len(normalizer.filter_nontarget({identifier})), len(normalizer2.filter_nontarget({entity})))
+		# Snapshots are only valid for the target resource they were compiled for
+		config["target_resource"] = "CHEBI"
+		with self.assertRaises(ValueError):
+			DictionaryNormalizer(config, target_MESH)
+
+	def test_snapshot_version(self):
+		normalizer = DictionaryNormalizer(self.config, target_MESH)
+		snapshot_filename = os.path.join(self.directory.name, "dictionary.snapshot")
+		normalizer.flatten()
+		dictionary_snapshot.write(normalizer, snapshot_filename, "MESH")
+		with open(snapshot_filename, "r+b") as file:
+			file.seek(8)
+			file.write(bytes(4))
+		with self.assertRaises(ValueError):
+			dictionary_snapshot.DictionarySnapshot(snapshot_filename)
+
+if __name__ == '__main__':
+	unittest.main()
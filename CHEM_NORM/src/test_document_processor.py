@@ -0,0 +1,235 @@
+import contextlib
+import io
+import os
+import tempfile
+import unittest
+
+from bioc import biocxml
+
+import file_ranges
+import normalize
+from abbreviations import AbbreviationExpander
+from dictionary_normalizer import DictionaryNormalizer
+from document_processor import DocumentProcessor
+from document_processor_PubTator import PubTatorDocumentProcessor
+from document_processor_TSV import TSVDocumentProcessor
+from test_dictionary_normalizer import target_MESH, write_dictionary
+
+class TestDocumentProcessor(unittest.TestCase):
+
+	# Collection with infons, sentences and document level annotations and relations
+	xml = """<?xml version='1.0' encoding='utf-8' standalone='yes'?>
+<collection><source>s</source><date>d</date><key>k</key><infon key="a">b</infon>
+<document><id>1</id><infon key="x">é</infon>
+<passage><infon key="p">q</infon><offset>0</offset><text>Sodium
+chloride α</text>
+<sentence><offset>0</offset><text>Sodium</text></sentence>
+<annotation id="A1"><infon key="type">Chemical</infon><location offset="0" length="15"/><text>Sodium chloride</text></annotation>
+<relation id="R1"><infon key="type">X</infon><node refid="A1" role="r"/></relation>
+</passage>
+<annotation id="D1"><infon key="type">Chemical</infon><location offset="0" length="6"/><text>Sodium</text></annotation>
+<relation><node refid="D1" role="r"/></relation>
+</document>
+<document><id>2</id></document>
+</collection>
+"""
+
+	def process(self, xml, streaming):
+		with tempfile.TemporaryDirectory() as directory:
+			input_filename = os.path.join(directory, "input.xml")
+			output_filename = os.path.join(directory, "output.xml")
+			with open(input_filename, "w") as file:
+				file.write(xml)
+			doc_processor = DocumentProcessor(dict(), AbbreviationExpander())
+			doc_processor.streaming = streaming
+			doc_processor.process_file(input_filename, output_filename)
+			with open(output_filename) as file:
+				return file.read()
+
+	def test_streaming(self):
+		output = self.process(self.xml, True)
+		self.assertEqual(self.process(self.xml, False), output)
+		self.assertIn("<infon key=\"a\">b</infon>", output)
+		self.assertIn("<id>2</id>", output)
+		# A collection without documents still gets its header
+		empty_xml = "<?xml version='1.0' encoding='utf-8'?>\n<collection><source>s</source><date>d</date><key>k</key></collection>\n"
+		self.assertEqual(self.process(empty_xml, False), self.process(empty_xml, True))
+
+	def test_post_log(self):
+		# The POST lines log ID strings as sets, whether or not the IDs are interned
+		with tempfile.TemporaryDirectory() as directory:
+			config = write_dictionary(directory)
+			for intern_ids in (False, True):
+				doc_processor = DocumentProcessor({"Chemical": DictionaryNormalizer(dict(config, intern_ids = intern_ids), target_MESH)}, AbbreviationExpander())
+				output = io.StringIO()
+				with contextlib.redirect_stdout(output):
+					doc_processor.process_document(biocxml.loads(self.xml).documents[0])
+				self.assertIn("POST\t1\tSodium chloride\t[0, 3]\t{'MESH:D012965'}\tUNAMBIGUOUS\n", output.getvalue())
+
+	def test_trace_lookups(self):
+		# Each LOOKUP line follows the MENTION line of its mention
+		with tempfile.TemporaryDirectory() as directory:
+			input_filename = os.path.join(directory, "input.pubtator")
+			with open(input_filename, "w") as file:
+				file.write("1|t|NaCl and glucose\n1|a|\n1\t0\t4\tNaCl\tChemical\n1\t9\t16\tglucose\tChemical\n")
+			normalizer = DictionaryNormalizer(dict(write_dictionary(directory), trace_lookups = True), target_MESH)
+			doc_processor = PubTatorDocumentProcessor({"Chemical": normalizer}, AbbreviationExpander())
+			output = io.StringIO()
+			with contextlib.redirect_stdout(output):
+				for document in doc_processor.read_documents(input_filename):
+					doc_processor.process_document(document)
+			lines = [line.split("\t")[0] for line in output.getvalue().split("\n") if line.startswith("MENTION") or line.startswith("LOOKUP")]
+			self.assertEqual(["MENTION", "LOOKUP", "MENTION", "LOOKUP"], lines)
+
+	def test_abbr_from_input(self):
+		# The ABBR relations of each document expand its mentions and are dropped once it is processed
+		xml = """<?xml version='1.0' encoding='utf-8'?>
+<collection><source>s</source><date>d</date><key>k</key>
+<document><id>1</id>
+<passage><offset>0</offset><text>sodium chloride (SC) and SC</text>
+<annotation id="A1"><infon key="type">ABBR</infon><location offset="0" length="15"/><text>sodium chloride</text></annotation>
+<annotation id="A2"><infon key="type">ABBR</infon><location offset="17" length="2"/><text>SC</text></annotation>
+<annotation id="A3"><infon key="type">Chemical</infon><location offset="25" length="2"/><text>SC</text></annotation>
+<relation id="R1"><infon key="type">ABBR</infon><node refid="A1" role="LongForm"/><node refid="A2" role="ShortForm"/></relation>
+</passage>
+</document>
+<document><id>2</id>
+<passage><offset>0</offset><text>SC</text>
+<annotation id="A1"><infon key="type">Chemical</infon><location offset="0" length="2"/><text>SC</text></annotation>
+</passage>
+</document>
+</collection>
+"""
+		with tempfile.TemporaryDirectory() as directory:
+			abbr = AbbreviationExpander()
+			abbr.add("2", "SC", "salt")
+			doc_processor = DocumentProcessor({"Chemical": DictionaryNormalizer(write_dictionary(directory), target_MESH)}, abbr)
+			doc_processor.abbr_from_input = True
+			documents = biocxml.loads(xml).documents
+			for document in documents:
+				doc_processor.process_document(document)
+			self.assertEqual(["MESH:D012965"], [annotation.infons["identifier"] for annotation in documents[0].passages[0].annotations])
+			self.assertEqual(["MESH:D012965"], [annotation.infons["identifier"] for annotation in documents[1].passages[0].annotations])
+			# Abbreviations that were already loaded are kept
+			self.assertEqual({"2": {"SC": "salt"}}, abbr.abbr_dict)
+			# Without the option the relations are not used
+			documents = biocxml.loads(xml).documents
+			doc_processor.abbr_from_input = False
+			doc_processor.process_document(documents[0])
+			self.assertEqual(["-"], [annotation.infons["identifier"] for annotation in documents[0].passages[0].annotations])
+
+	def test_read_pubtator(self):
+		with tempfile.TemporaryDirectory() as directory:
+			input_filename = os.path.join(directory, "input.pubtator")
+			with open(input_filename, "w") as file:
+				file.write("1|t|Sodium chloride\n1|a|In |t| and |a|\n1\t0\t6\tSodium\tChemical\n1\t7\t10\ta|t|b\tChemical\n1\t0\t6\tSodium\tGene\n\n\n2|t|Glucose\n2|a|\n")
+			doc_processor = PubTatorDocumentProcessor({"Chemical": None}, AbbreviationExpander())
+			documents = list(doc_processor.read_documents(input_filename))
+			self.assertEqual(["1", "2"], [document.id for document in documents])
+			self.assertEqual("In ", documents[0].abstract)
+			# Only the marker after the document ID starts a title or abstract
+			self.assertEqual(["Sodium", "a|t|b"], [annotation.text for annotation in documents[0].annotations])
+			self.assertEqual([], documents[1].annotations)
+			self.assertEqual({"1", "2"}, doc_processor.get_document_ids(input_filename))
+
+	def test_ranges(self):
+		pubtator = "".join(str(id) + "|t|Title é\n" + str(id) + "|a|Abstract\n" + str(id) + "\t0\t5\tTitle\tChemical\n\n" for id in range(20))
+		tsv = "".join(str(id // 3) + "\t0\t5\tTitle\tChemical\n" for id in range(60))
+		with tempfile.TemporaryDirectory() as directory:
+			for filename, text, doc_processor in [("input.pubtator", pubtator, PubTatorDocumentProcessor({"Chemical": None}, None)), ("input.tsv", tsv, TSVDocumentProcessor({"Chemical": None}, None))]:
+				filename = os.path.join(directory, filename)
+				with open(filename, "w") as file:
+					file.write(text)
+				for parts in [1, 3, 7, 100]:
+					input_ranges = doc_processor.get_ranges(filename, parts)
+					self.assertEqual(min(parts, 20), len(input_ranges))
+					texts = list()
+					for input_range in input_ranges:
+						with file_ranges.open_input(filename, input_range) as input_file:
+							texts.append(input_file.read())
+					self.assertEqual(text, "".join(texts))
+					# No document continues into the next range
+					for previous_text, range_text in zip(texts, texts[1:]):
+						last_line = previous_text.strip().split("\n")[-1]
+						self.assertNotEqual(last_line.split("|")[0].split("\t")[0], range_text.split("|")[0].split("\t")[0])
+
+	def test_process_split(self):
+		pubtator = "".join(str(id) + "|t|Sodium chloride\n" + str(id) + "|a|NaCl and glucose\n" + str(id) + "\t0\t15\tSodium chloride\tChemical\n" + str(id) + "\t20\t27\tglucose\tChemical\n\n" for id in range(10))
+		with tempfile.TemporaryDirectory() as directory:
+			doc_processor = PubTatorDocumentProcessor({"Chemical": DictionaryNormalizer(write_dictionary(directory), target_MESH)}, AbbreviationExpander())
+			for text, identifier_count in [(pubtator, 20), ("", 0)]:
+				input_filename = os.path.join(directory, "input.pubtator")
+				with open(input_filename, "w") as file:
+					file.write(text)
+				output_filename = os.path.join(directory, "output.pubtator")
+				doc_processor.process_file(input_filename, output_filename)
+				with open(output_filename) as file:
+					output = file.read()
+				self.assertEqual(identifier_count, output.count("\tMESH:"))
+				for parts in [1, 3]:
+					split_output_filename = os.path.join(directory, "split.pubtator")
+					normalize.process_split(doc_processor, input_filename, split_output_filename, parts)
+					with open(split_output_filename) as file:
+						self.assertEqual(output, file.read())
+
+	def test_process_directory(self):
+		with tempfile.TemporaryDirectory() as directory:
+			input_directory = os.path.join(directory, "input")
+			os.mkdir(input_directory)
+			for index, texts in enumerate([["Sodium chloride", "glucose"], ["NaCl", "Sodium chloride"], ["salts"], ["unknown", "glucose", "NaCl"]]):
+				with open(os.path.join(input_directory, str(index) + ".pubtator"), "w") as file:
+					file.write(str(index) + "|t|Title\n" + str(index) + "|a|Abstract\n" + "".join(str(index) + "\t0\t5\t" + text + "\tChemical\n" for text in texts) + "\n")
+			tasks = list()
+			for item in sorted(os.listdir(input_directory)):
+				tasks.append((os.path.join(input_directory, item), None, os.path.join(directory, item)))
+			config = write_dictionary(directory)
+			doc_processor = PubTatorDocumentProcessor({"Chemical": DictionaryNormalizer(config, target_MESH)}, AbbreviationExpander())
+			outputs = list()
+			for input_filename, input_range, output_filename in tasks:
+				doc_processor.process_file(input_filename, output_filename)
+				with open(output_filename) as file:
+					outputs.append(file.read())
+			sequential_cache = doc_processor.type2normalizer["Chemical"].mention_cache
+			normalizer = DictionaryNormalizer(config, target_MESH)
+			doc_processor = PubTatorDocumentProcessor({"Chemical": normalizer}, AbbreviationExpander())
+			normalize.process_directory(doc_processor, tasks, 2)
+			for (input_filename, input_range, output_filename), output in zip(tasks, outputs):
+				with open(output_filename) as file:
+					self.assertEqual(output, file.read())
+			# The statistics of the workers are added to the normalizer of the parent
+			self.assertEqual(0, len(normalizer.mention_cache))
+			self.assertEqual(sequential_cache.hits + sequential_cache.misses, normalizer.mention_cache.hits + normalizer.mention_cache.misses)
+			self.assertEqual(8, normalizer.mention_cache.hits + normalizer.mention_cache.misses)
+
+	def test_tsv_modes(self):
+		rows = ["2\t0\t4\tNaCl\tChemical", "1\t0\t7\tglucose\tChemical", "3\t0\t4\tsalt\tGene", "2\t5\t7\tSC\tChemical", "", "4\t0\t7\tunknown\tChemical", "1\t8\t12\tsalt\tChemical"]
+		with tempfile.TemporaryDirectory() as directory:
+			def write(filename, text):
+				filename = os.path.join(directory, filename)
+				with open(filename, "w") as file:
+					file.write(text)
+				return filename
+			abbr = AbbreviationExpander()
+			abbr.add("2", "SC", "sodium chloride")
+			doc_processor = TSVDocumentProcessor({"Chemical": DictionaryNormalizer(write_dictionary(directory), target_MESH)}, abbr)
+			doc_processor.spill_buckets = 3
+			unsorted_filename = write("unsorted.tsv", "\n".join(rows))
+			sorted_filename = write("sorted.tsv", "\n".join(sorted(rows)))
+			def process(mode, input_filename):
+				doc_processor.mode = mode
+				output_filename = os.path.join(directory, "output.tsv")
+				doc_processor.process_file(input_filename, output_filename)
+				with open(output_filename) as file:
+					return file.read()
+			output = process("memory", unsorted_filename)
+			self.assertTrue(output.startswith("2\t0\t4\tNaCl\tChemical\tMESH:D012965\n2\t5\t7\tSC\tChemical\tMESH:D012965\n\n1\t0\t7\tglucose\tChemical\tMESH:D005947\n"))
+			self.assertEqual(output, process("spill", unsorted_filename))
+			output = process("memory", sorted_filename)
+			self.assertEqual(output, process("sorted", sorted_filename))
+			self.assertEqual(output, process("spill", sorted_filename))
+			# Sorted mode requires the rows of each document to be contiguous
+			with self.assertRaises(ValueError):
+				process("sorted", unsorted_filename)
+
+if __name__ == '__main__':
+	unittest.main()
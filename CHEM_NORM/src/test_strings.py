@@ -53,6 +53,17 @@ class TestStrings(unittest.TestCase):
 		self.assertEqual("a\"b\"c\"d''e``f", strings.map_to_ASCII("a\"b\u201Cc\u201Dd\u2033e\u2036f"))
 		# Check Others
 		self.assertEqual("a b*c+-d(c)e(r)f g-h", strings.map_to_ASCII("a b\xB7c\xB1d\xA9e\xAEf\u2122g\u2192h"))
+
+		# Check whitespace, with and without non-ASCII characters
+		self.assertEqual("a b", strings.map_to_ASCII("\t a \n  b "))
+		self.assertEqual("a b alphabeta", strings.map_to_ASCII("\t a \n  b \u03B1\u03B2"))
 		
+	def test_apply_tokenwise(self):
+		self.assertEqual(["Sodium", "Chloride", "-", "2", "_", "x"], strings.tokenize("SodiumChloride-2 _x"))
+		self.assertEqual("Sodium Chloride - 2 _ x", strings.spacify("SodiumChloride-2 _x"))
+		self.assertEqual("", strings.spacify(""))
+		self.assertEqual("cl- NaCl  acid salt", strings.apply_tokenwise("cl- NaCls  acids salt", strings.s_stem))
+		self.assertEqual("sodium chloride  ACID", strings.apply_tokenwise("Sodium Chloride  ACID", strings.firstcaps_lower))
+
 if __name__ == '__main__':
 	unittest.main()